@@ -0,0 +1,2 @@
+# Keeps the repo root importable so tests can load the off-chain helpers
+# (relayer, client, ...) that sit next to the contracts.
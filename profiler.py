@@ -0,0 +1,202 @@
+"""
+CPU profiler for contracts run under ContractingClient.
+
+Records CPU time per export and per internal function of the profiled
+contracts, plus every call those functions make directly (stdlib bridge
+helpers such as `strptime`, `hashlib.sha3` and `crypto.verify`, Decimal and
+Datetime arithmetic, Hash reads and writes). Anything deeper is folded into
+the direct call, so stacks stay readable.
+
+    with ContractProfiler(["currency"]) as profiler:
+        client.get_contract("currency").create_stream(...)
+    profiler.write_collapsed("currency.collapsed")
+
+`python profiler.py [output]` deploys token_xsc003.py on a fresh
+ContractingClient, profiles a sample streaming workload and writes its
+collapsed stacks (default `token_xsc003.collapsed`).
+
+The output is the collapsed-stack format read by flamegraph.pl, speedscope
+and inferno; counts are microseconds of CPU time. Profiling is opt-in and
+only active inside the `with` block or between `start()` and `stop()`.
+"""
+import sys
+import time
+from collections import defaultdict
+from typing import Callable, Iterable, List, Tuple
+
+# contracting stores private functions under this prefix
+PRIVATE_PREFIX = "__"
+
+CHAIN_ID = "profile-chain"
+
+
+def function_name(code) -> str:
+    name = getattr(code, "co_qualname", code.co_name)
+    if name.startswith(PRIVATE_PREFIX) and not name.endswith(PRIVATE_PREFIX):
+        return name[len(PRIVATE_PREFIX):]
+    return name
+
+
+def callee_name(frame) -> str:
+    module = frame.f_globals.get("__name__", "?")
+    return f"{module.rsplit('.', 1)[-1]}.{getattr(frame.f_code, 'co_qualname', frame.f_code.co_name)}"
+
+
+def builtin_name(func) -> str:
+    owner = getattr(func, "__self__", None)
+    if owner is not None and not isinstance(owner, type(sys)):
+        owner = owner if isinstance(owner, type) else type(owner)
+        return f"{owner.__name__}.{func.__name__}"
+    return getattr(func, "__qualname__", repr(func))
+
+
+class ContractProfiler:
+    def __init__(self, contracts: Iterable[str] = ("currency",), clock: Callable[[], int] = time.thread_time_ns):
+        self.contracts = set(contracts)
+        self.clock = clock
+        self.samples = defaultdict(int)
+        self.stack = []
+        # Frames (by id) and C calls that pushed an entry on self.stack
+        self.pushed = {}
+        self.last = None
+        self.previous_profile = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.previous_profile = sys.getprofile()
+        self.last = self.clock()
+        sys.setprofile(self.profile)
+
+    def stop(self):
+        sys.setprofile(self.previous_profile)
+        self.charge()
+        self.stack.clear()
+        self.pushed.clear()
+
+    def reset(self):
+        self.samples.clear()
+
+    def is_contract(self, frame) -> bool:
+        return frame is not None and frame.f_globals.get("__name__") in self.contracts
+
+    # Adds the time since the previous event to the current stack
+    def charge(self):
+        now = self.clock()
+        if self.stack:
+            self.samples[tuple(self.stack)] += now - self.last
+        self.last = now
+
+    def profile(self, frame, event, arg):
+        if event == "call":
+            if self.is_contract(frame):
+                name = function_name(frame.f_code)
+            elif self.is_contract(frame.f_back):
+                name = callee_name(frame)
+            else:
+                return
+            self.charge()
+            self.stack.append(name)
+            self.pushed[id(frame)] = True
+        elif event == "return":
+            if self.pushed.pop(id(frame), None):
+                self.charge()
+                self.stack.pop()
+        elif event == "c_call":
+            if self.is_contract(frame):
+                self.charge()
+                self.stack.append(builtin_name(arg))
+        elif event in ("c_return", "c_exception"):
+            if self.is_contract(frame) and self.stack:
+                self.charge()
+                self.stack.pop()
+
+    # Self and total CPU time in nanoseconds per function, by total time
+    def function_times(self) -> List[Tuple[str, int, int]]:
+        own = defaultdict(int)
+        total = defaultdict(int)
+        for stack, elapsed in self.samples.items():
+            own[stack[-1]] += elapsed
+            for name in set(stack):
+                total[name] += elapsed
+
+        return sorted(((name, own[name], total[name]) for name in total), key=lambda row: -row[2])
+
+    def collapsed(self) -> List[str]:
+        lines = []
+        for stack, elapsed in sorted(self.samples.items()):
+            micros = elapsed // 1000
+            if micros > 0:
+                lines.append(f"{';'.join(stack)} {micros}")
+        return lines
+
+    def write_collapsed(self, path: str):
+        with open(path, "w") as f:
+            for line in self.collapsed():
+                f.write(line + "\n")
+
+    def report(self, limit: int = 20) -> str:
+        lines = [f"{'function':<48} {'self ms':>10} {'total ms':>10}"]
+        for name, own, total in self.function_times()[:limit]:
+            lines.append(f"{name:<48} {own / 1e6:>10.3f} {total / 1e6:>10.3f}")
+        return "\n".join(lines)
+
+
+# Creates, settles and finalizes plain, schedule and permit streams
+def run_sample_workload(client, streams: int = 50):
+    from contracting.stdlib.bridge.time import Datetime
+    from xian_py.wallet import Wallet
+
+    currency = client.get_contract("currency")
+    wallet = Wallet()
+    sender = wallet.public_key
+    currency.balances[sender] = 10_000_000
+    begins = Datetime(year=2024, month=1, day=1)
+    closes = Datetime(year=2024, month=1, day=2)
+    deadline = Datetime(year=2024, month=2, day=1)
+
+    for i in range(streams):
+        receiver = f"receiver_{i}"
+        rate = i + 1
+        stream_id = currency.create_stream(receiver=receiver, rate=rate, begins=str(begins), closes=str(closes), signer=sender)
+        currency.balance_stream(stream_id=stream_id, signer=receiver, environment={"now": Datetime(year=2024, month=1, day=1, hour=12)})
+        currency.balance_finalize(stream_id=stream_id, signer=receiver, environment={"now": closes})
+
+        currency.create_schedule_stream(
+            receiver=receiver, begins=str(begins), closes=str(closes),
+            starts=[str(begins), "2024-01-01 06:00:00"], rates=[rate, rate * 2], signer=sender
+        )
+
+        msg = f"{sender}:{receiver}:{rate}:{begins}:{closes}:{deadline}:currency:{CHAIN_ID}"
+        currency.create_stream_from_permit(
+            sender=sender, receiver=receiver, rate=rate, begins=str(begins), closes=str(closes),
+            deadline=str(deadline), signature=wallet.sign_msg(msg), signer=receiver,
+            environment={"now": begins, "chain_id": CHAIN_ID}
+        )
+
+
+def main(argv: List[str]):
+    from contracting.client import ContractingClient
+
+    output = argv[1] if len(argv) > 1 else "token_xsc003.collapsed"
+
+    client = ContractingClient(environment={"chain_id": CHAIN_ID})
+    client.flush()
+    with open("token_xsc003.py") as f:
+        client.submit(f.read(), name="currency")
+
+    with ContractProfiler(["currency"]) as profiler:
+        run_sample_workload(client)
+
+    profiler.write_collapsed(output)
+    print(profiler.report())
+    print(f"Wrote {output}")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,914 @@
+"""
+Pure-Python reference engine for token_xsc003.py.
+
+Implements the same transfers, permits, streams, settlement and capping rules
+as the contract on plain dicts and `__slots__` records, so long simulations
+(e.g. months of streaming for capacity planning) run without a
+ContractingClient. Failed calls raise AssertionError with the contract's
+messages and leave state untouched, like a reverted transaction.
+
+Amounts follow contracting's number handling: float arguments, including
+those inside list arguments, become `decimal.Decimal` (ContractingDecimal in
+the contract) and are computed under contracting's decimal context, so
+fractional rates and amounts settle to the same values as on chain.
+
+The current block time is `engine.now`, in UTC like the contract's `now`; every
+export takes the caller as `signer`, mirroring `ContractingClient` calls. tests/test_reference_engine.py
+replays random operation sequences through both engines and compares state.
+"""
+import datetime
+import decimal
+import functools
+import hashlib
+from typing import Any, Callable, Optional
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+STREAM_ACTIVE = "active"
+STREAM_FINALIZED = "finalized"
+STREAM_FORFEIT = "forfeit"
+STREAM_MERGED = "merged"
+MAX_AUTO_SETTLE = 5
+
+# Mirrors contracting.stdlib.bridge.decimal's context for ContractingDecimal
+# arithmetic. It is only active inside the engine's calls (see in_decimal_context),
+# so importing this module leaves the caller's decimal context alone
+DECIMAL_CONTEXT = decimal.Context(prec=61, rounding=decimal.ROUND_FLOOR, Emin=-100, Emax=100)
+
+
+def in_decimal_context(function: Callable) -> Callable:
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        # Swapping the context in is much cheaper than decimal.localcontext,
+        # which copies it on every call
+        saved = decimal.getcontext()
+        decimal.setcontext(DECIMAL_CONTEXT)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            decimal.setcontext(saved)
+    return wrapper
+
+
+def require(condition: Any, message: str):
+    if not condition:
+        raise AssertionError(message)
+
+
+# Mirrors contracting's hashlib.sha3, which hashes hex strings as bytes
+def sha3(value: str) -> str:
+    try:
+        data = bytes.fromhex(value)
+    except ValueError:
+        data = value.encode()
+    return hashlib.sha3_256(data).hexdigest()
+
+
+# Mirrors contracting's crypto.verify
+def verify(vk: str, msg: str, signature: str) -> bool:
+    from nacl.signing import VerifyKey
+
+    try:
+        VerifyKey(bytes.fromhex(vk)).verify(msg.encode(), bytes.fromhex(signature))
+    except Exception:
+        return False
+    return True
+
+
+# Naive UTC, like the contract's `now`
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+# The contracting executor turns float arguments into ContractingDecimal; the
+# contract converts floats nested in lists itself (its to_decimal)
+def to_decimal(value: Any) -> Any:
+    if isinstance(value, float):
+        return decimal.Decimal(str(value))
+    return value
+
+
+def strptime_ymdhms(date_string: str) -> datetime.datetime:
+    return datetime.datetime.strptime(date_string, TIME_FORMAT)
+
+
+def seconds_between(start: datetime.datetime, end: datetime.datetime) -> int:
+    return int((end - start).total_seconds())
+
+
+class StreamRecord:
+    __slots__ = ("status", "sender", "receiver", "begins", "closes", "rate", "claimed", "schedule", "deposit", "merged_into", "period")
+
+    def __init__(self, sender, receiver, begins, closes, rate, schedule=None, deposit=None, period=None):
+        self.status = STREAM_ACTIVE
+        self.sender = sender
+        self.receiver = receiver
+        self.begins = begins
+        self.closes = closes
+        self.rate = rate
+        self.claimed = 0
+        self.schedule = schedule
+        self.deposit = deposit
+        self.merged_into = None
+        self.period = period
+
+
+class ReferenceEngine:
+    def __init__(self, operator: str = "sys", contract: str = "currency", chain_id: str = "",
+                 now: Optional[datetime.datetime] = None, verify: Callable[[str, str, str], bool] = verify):
+        self.contract = contract
+        self.chain_id = chain_id
+        self.now = utcnow() if now is None else now
+        self.verify = verify
+
+        self.balances = {}
+        self.allowances = {}
+        self.permits = set()
+        self.streams = {}
+        # close_buckets[bucket, i] for close_bucket_heads[bucket] <= i < close_bucket_tails[bucket]
+        self.close_buckets = {}
+        self.close_bucket_heads = {}
+        self.close_bucket_tails = {}
+        # incoming_streams[receiver, i] for incoming_stream_heads[receiver] <= i < incoming_stream_tails[receiver]
+        self.incoming_streams = {}
+        self.incoming_stream_heads = {}
+        self.incoming_stream_tails = {}
+        self.auto_settle = {}
+
+        self.balances[operator] = 1_000_000
+        self.total_supply = 1_000_000
+        self.holder_count = 1
+        self.stream_counter = 0
+        self.stream_stats = {
+            "active_count": 0,
+            "active_rate": 0,
+            "total_streamed": 0,
+            "total_claimed": 0,
+        }
+        self.metadata = {
+            'token_name': "TEST TOKEN",
+            'token_symbol': "TST",
+            'token_logo_url': 'https://some.token.url/test-token.png',
+            'token_website': 'https://some.token.url',
+            'operator': operator,
+        }
+
+    # XST001
+
+    @in_decimal_context
+    def change_metadata(self, signer: str, key: str, value: Any):
+        require(signer == self.metadata['operator'], 'Only operator can set metadata.')
+        self.metadata[key] = value
+
+    @in_decimal_context
+    def transfer(self, signer: str, amount: Any, to: str):
+        amount = to_decimal(amount)
+        require(amount > 0, 'Cannot send negative balances.')
+        self.require_spendable(signer, amount)
+
+        self.debit(signer, amount)
+        self.credit(to, amount)
+
+        return f"Sent {amount} to {to}"
+
+    @in_decimal_context
+    def approve(self, signer: str, amount: Any, to: str):
+        amount = to_decimal(amount)
+        require(amount >= 0, 'Cannot send negative balances.')
+        self.allowances[signer, to] = self.allowances.get((signer, to), 0) + amount
+
+        return f"Approved {amount} for {to}"
+
+    @in_decimal_context
+    def transfer_from(self, signer: str, amount: Any, to: str, main_account: str):
+        amount = to_decimal(amount)
+        require(amount > 0, 'Cannot send negative balances.')
+        allowance = self.allowances.get((main_account, signer), 0)
+        require(allowance >= amount, f'Not enough coins approved to send. You have {allowance} and are trying to spend {amount}')
+        self.require_spendable(main_account, amount)
+
+        self.allowances[main_account, signer] = allowance - amount
+        self.debit(main_account, amount)
+        self.credit(to, amount)
+
+        return f"Sent {amount} to {to} from {main_account}"
+
+    @in_decimal_context
+    def transfer_many(self, signer: str, recipients: list, amounts: list):
+        amounts = [to_decimal(amount) for amount in amounts]
+        total = self.calc_batch_total(recipients, amounts)
+
+        self.require_spendable(signer, total)
+
+        self.debit(signer, total)
+        for recipient, amount in zip(recipients, amounts):
+            self.credit(recipient, amount)
+
+        return f"Sent {total} to {len(recipients)} recipients"
+
+    @in_decimal_context
+    def transfer_from_many(self, signer: str, recipients: list, amounts: list, main_account: str):
+        amounts = [to_decimal(amount) for amount in amounts]
+        total = self.calc_batch_total(recipients, amounts)
+        allowance = self.allowances.get((main_account, signer), 0)
+
+        require(allowance >= total, f'Not enough coins approved to send. You have {allowance} and are trying to spend {total}')
+        self.require_spendable(main_account, total)
+
+        self.allowances[main_account, signer] = allowance - total
+        self.debit(main_account, total)
+        for recipient, amount in zip(recipients, amounts):
+            self.credit(recipient, amount)
+
+        return f"Sent {total} to {len(recipients)} recipients from {main_account}"
+
+    def calc_batch_total(self, recipients: list, amounts: list) -> Any:
+        require(len(recipients) > 0, 'No recipients given.')
+        require(len(recipients) == len(amounts), 'Recipients and amounts must have the same length.')
+
+        total = 0
+        for amount in amounts:
+            require(amount > 0, 'Cannot send negative balances.')
+            total += amount
+
+        return total
+
+    @in_decimal_context
+    def set_auto_settle(self, signer: str, enabled: bool):
+        self.auto_settle[signer] = enabled
+
+        return f"Auto settle {'enabled' if enabled else 'disabled'} for {signer}"
+
+    # Settle-on-spend followed by the balance check. If the balance is still too
+    # low, the settlements are undone, as the contract's transaction would revert
+    def require_spendable(self, account: str, amount: Any):
+        if self.balances.get(account, 0) >= amount or not self.auto_settle.get(account):
+            require(self.balances.get(account, 0) >= amount, 'Not enough coins to send.')
+            return
+
+        saved_balances = {}
+        saved_streams = []
+        saved_holder_count = self.holder_count
+        saved_stats = dict(self.stream_stats)
+        first = self.incoming_stream_heads.get(account, 0)
+        end = min(first + MAX_AUTO_SETTLE, self.incoming_stream_tails.get(account, 0))
+        dropped = []
+        settled = []
+
+        for i in range(first, end):
+            if self.balances.get(account, 0) >= amount:
+                continue
+
+            stream_id = self.incoming_streams[account, i]
+            stream = self.load_stream(stream_id)
+
+            if stream.status == STREAM_ACTIVE:
+                if self.now <= stream.begins:
+                    continue
+
+                outstanding_balance = self.calc_stream_outstanding(stream)
+
+                if outstanding_balance <= 0:
+                    continue
+
+                for address in (account, stream.sender):
+                    if address not in saved_balances:
+                        saved_balances[address] = self.balances.get(address)
+                saved_streams.append((stream, stream.claimed, stream.deposit))
+
+                if self.pay_stream(stream, outstanding_balance) <= 0:
+                    continue
+
+                settled.append(stream_id)
+
+            dropped.append(i)
+
+        if self.balances.get(account, 0) < amount:
+            for stream, claimed, deposit in reversed(saved_streams):
+                stream.claimed = claimed
+                stream.deposit = deposit
+            for address, balance in saved_balances.items():
+                if balance is None:
+                    del self.balances[address]
+                else:
+                    self.balances[address] = balance
+            self.holder_count = saved_holder_count
+            self.stream_stats = saved_stats
+            raise AssertionError('Not enough coins to send.')
+
+        # Same removal as the contract: the head entry, already looked at, takes the
+        # dropped entry's slot and the head moves up by one
+        head = first
+        for i in dropped:
+            if i != head:
+                self.incoming_streams[account, i] = self.incoming_streams[account, head]
+            del self.incoming_streams[account, head]
+            head += 1
+
+        if head != first:
+            self.incoming_stream_heads[account] = head
+
+        for stream_id in settled:
+            self.add_incoming_stream(account, stream_id)
+
+    def add_incoming_stream(self, receiver: str, stream_id: str):
+        tail = self.incoming_stream_tails.get(receiver, 0)
+        self.incoming_streams[receiver, tail] = stream_id
+        self.incoming_stream_tails[receiver] = tail + 1
+
+    def balance_of(self, signer: str, address: str):
+        return self.balances.get(address, 0)
+
+    def allowance(self, signer: str, owner: str, spender: str):
+        return self.allowances.get((owner, spender), 0)
+
+    def get_total_supply(self, signer: str):
+        return self.total_supply
+
+    def get_holder_count(self, signer: str):
+        return self.holder_count
+
+    def get_stream_stats(self, signer: str):
+        return dict(self.stream_stats)
+
+    def debit(self, address: str, amount: Any):
+        balance = self.balances.get(address, 0) - amount
+        self.balances[address] = balance
+
+        if amount > 0 and balance == 0:
+            self.holder_count -= 1
+
+    def credit(self, address: str, amount: Any):
+        balance = self.balances.get(address, 0)
+        self.balances[address] = balance + amount
+
+        if amount > 0 and balance == 0:
+            self.holder_count += 1
+
+    # XST002 / Permit
+
+    @in_decimal_context
+    def permit(self, signer: str, owner: str, spender: str, value: Any, deadline: str, signature: str):
+        value = to_decimal(value)
+        deadline = strptime_ymdhms(deadline)
+        permit_msg = f"{owner}:{spender}:{value}:{deadline}:{self.contract}:{self.chain_id}"
+        permit_hash = sha3(permit_msg)
+
+        require(permit_hash not in self.permits, 'Permit can only be used once.')
+        require(self.now < deadline, 'Permit has expired.')
+        require(self.verify(owner, permit_msg, signature), 'Invalid signature.')
+
+        self.allowances[owner, spender] = self.allowances.get((owner, spender), 0) + value
+        self.permits.add(permit_hash)
+
+        return f"Permit granted for {value} to {spender} from {owner}"
+
+    # XST003 / Streaming Payments
+
+    @in_decimal_context
+    def create_stream(self, signer: str, receiver: str, rate: Any, begins: str, closes: str):
+        return self.perform_create_stream(signer, receiver, to_decimal(rate), strptime_ymdhms(begins), strptime_ymdhms(closes))
+
+    @in_decimal_context
+    def create_escrow_stream(self, signer: str, receiver: str, rate: Any, begins: str, closes: str):
+        return self.perform_create_stream(signer, receiver, to_decimal(rate), strptime_ymdhms(begins), strptime_ymdhms(closes), escrow=True)
+
+    @in_decimal_context
+    def create_schedule_stream(self, signer: str, receiver: str, begins: str, closes: str, starts: list, rates: list):
+        begins = strptime_ymdhms(begins)
+        closes = strptime_ymdhms(closes)
+        schedule = self.build_schedule(begins, closes, starts, rates)
+
+        return self.perform_create_stream(signer, receiver, schedule[-1][1], begins, closes, schedule)
+
+    @in_decimal_context
+    def create_subscription_stream(self, signer: str, receiver: str, amount: Any, period: int, begins: str, max_periods: Optional[int] = None):
+        amount = to_decimal(amount)
+        begins = strptime_ymdhms(begins)
+
+        require(period > 0, 'Period must be greater than 0.')
+
+        closes = None
+        if max_periods is not None:
+            require(max_periods > 0, 'Max periods must be greater than 0.')
+            closes = begins + datetime.timedelta(seconds=period * max_periods)
+
+        return self.perform_create_stream(signer, receiver, amount, begins, closes, period=period)
+
+    @in_decimal_context
+    def create_stream_from_permit(self, signer: str, sender: str, receiver: str, rate: Any, begins: str, closes: str, deadline: str, signature: str):
+        rate = to_decimal(rate)
+        begins = strptime_ymdhms(begins)
+        closes = strptime_ymdhms(closes)
+        deadline = strptime_ymdhms(deadline)
+
+        require(self.now < deadline, 'Permit has expired.')
+        permit_msg = f"{sender}:{receiver}:{rate}:{begins}:{closes}:{deadline}:{self.contract}:{self.chain_id}"
+        permit_hash = sha3(permit_msg)
+
+        require(permit_hash not in self.permits, 'Permit can only be used once.')
+        require(self.verify(sender, permit_msg, signature), 'Invalid signature.')
+
+        stream_id = sha3(f"{sender}:{receiver}:{begins}:{closes}:{rate}")
+        self.perform_create_stream(sender, receiver, rate, begins, closes, stream_id=stream_id)
+        self.permits.add(permit_hash)
+
+        return stream_id
+
+    def perform_create_stream(self, sender, receiver, rate, begins, closes, schedule=None, escrow=False, stream_id=None, period=None):
+        if stream_id is not None:
+            require(stream_id not in self.streams, 'Stream already exists.')
+        require(closes is None or begins < closes, 'Stream cannot begin after the close date.')
+        require(rate > 0, 'Rate must be greater than 0.')
+
+        deposit = None
+        if escrow:
+            deposit = self.calc_total_accrued(begins, closes, rate, schedule)
+            require(self.balances.get(sender, 0) >= deposit, 'Not enough coins to fund the stream.')
+            self.debit(sender, deposit)
+
+        if stream_id is None:
+            self.stream_counter += 1
+            stream_id = str(self.stream_counter)
+
+        self.streams[stream_id] = StreamRecord(sender, receiver, begins, closes, rate, schedule, deposit, period)
+
+        committed = 0
+        if closes is not None:
+            self.add_to_close_bucket(stream_id, closes)
+            committed = self.calc_total_accrued(begins, closes, rate, schedule, period)
+
+        self.add_incoming_stream(receiver, stream_id)
+        self.record_stream_stats(1, self.calc_active_rate(rate, period), committed, 0)
+
+        return stream_id
+
+    def build_schedule(self, begins, closes, starts: list, rates: list) -> list:
+        require(len(starts) > 0, 'Schedule must have at least one segment.')
+        require(len(starts) == len(rates), 'Schedule must have one rate per segment start.')
+
+        schedule = []
+        accrued = 0
+        previous = None
+
+        for start, rate in zip(starts, rates):
+            start = strptime_ymdhms(start)
+            rate = to_decimal(rate)
+
+            require(rate >= 0, 'Rate must not be negative.')
+
+            if previous is None:
+                require(start == begins, 'Schedule must start when the stream begins.')
+            else:
+                require(start > previous, 'Schedule segments must be in order.')
+                accrued += schedule[-1][1] * seconds_between(previous, start)
+
+            require(start < closes, 'Schedule segments must start before the close date.')
+
+            schedule.append([seconds_between(begins, start), rate, accrued])
+            previous = start
+
+        return schedule
+
+    @in_decimal_context
+    def balance_stream(self, signer: str, stream_id: str):
+        stream = self.load_stream(stream_id)
+
+        require(stream.status == STREAM_ACTIVE, 'You can only balance active streams.')
+        require(signer in (stream.sender, stream.receiver), 'Only sender or receiver can balance a stream.')
+
+        outstanding_balance = self.calc_settlement(stream)
+        claimable_amount = self.pay_stream(stream, outstanding_balance)
+
+        return f"Claimed {claimable_amount} tokens from stream"
+
+    @in_decimal_context
+    def change_close_time(self, signer: str, stream_id: str, new_close_time: str):
+        new_close_time = strptime_ymdhms(new_close_time)
+        stream = self.load_stream(stream_id)
+
+        require(stream.status == STREAM_ACTIVE, 'Stream is not active.')
+        require(signer == stream.sender, 'Only sender can extend the close time of a stream.')
+
+        closes = self.calc_close_time(stream.begins, new_close_time)
+
+        if stream.deposit is not None:
+            difference = self.check_deposit(stream, closes)
+
+        self.move_close_bucket(stream_id, stream.closes, closes)
+        self.set_close_time(stream, closes)
+
+        if stream.deposit is not None:
+            self.rebalance_deposit(stream, difference)
+
+        return f"Changed close time of stream to {closes}"
+
+    @in_decimal_context
+    def cancel_subscription(self, signer: str, stream_id: str):
+        stream = self.load_stream(stream_id)
+
+        require(stream.status == STREAM_ACTIVE, 'Stream is not active.')
+        require(stream.period is not None, 'Stream is not a subscription.')
+        require(signer in (stream.sender, stream.receiver), 'Only sender or receiver can cancel a subscription.')
+
+        closes = self.calc_period_end(stream.begins, stream.period)
+        if stream.closes is not None and stream.closes < closes:
+            closes = stream.closes
+
+        self.move_close_bucket(stream_id, stream.closes, closes)
+        self.set_close_time(stream, closes)
+
+        return f"Cancelled subscription, it ends at {closes}"
+
+    @in_decimal_context
+    def finalize_stream(self, signer: str, stream_id: str):
+        stream = self.load_stream(stream_id)
+
+        require(stream.status == STREAM_ACTIVE, 'Stream is not active.')
+        require(signer in (stream.sender, stream.receiver), 'Only sender or receiver can finalize a stream.')
+        require(stream.closes is not None and stream.closes <= self.now, 'Stream has not closed yet.')
+        require(self.calc_stream_outstanding(stream) == 0, 'Stream has outstanding balance.')
+
+        self.mark_finalized(stream)
+
+        return f"Finalized stream {stream_id}"
+
+    @in_decimal_context
+    def close_balance_finalize(self, signer: str, stream_id: str):
+        stream = self.load_stream(stream_id)
+
+        require(stream.status == STREAM_ACTIVE, 'Stream is not active.')
+        require(signer == stream.sender, 'Only sender can extend the close time of a stream.')
+
+        # Every check runs against a copy so a failure leaves the stream untouched
+        closes = self.calc_close_time(stream.begins, self.now)
+        trial = self.copy_stream(stream)
+        trial.closes = closes
+
+        if trial.deposit is not None:
+            difference = self.check_deposit(trial, closes)
+            trial.deposit += difference
+
+        outstanding_balance = self.calc_settlement(trial)
+        require(closes <= self.now, 'Stream has not closed yet.')
+        require(self.calc_claimable(trial, outstanding_balance) == outstanding_balance, 'Stream has outstanding balance.')
+
+        self.set_close_time(stream, closes)
+        if stream.deposit is not None:
+            self.rebalance_deposit(stream, difference)
+        self.pay_stream(stream, outstanding_balance)
+        self.mark_finalized(stream)
+
+        return f"Finalized stream {stream_id}"
+
+    @in_decimal_context
+    def balance_finalize(self, signer: str, stream_id: str):
+        stream = self.load_stream(stream_id)
+
+        require(stream.status == STREAM_ACTIVE, 'You can only balance active streams.')
+        require(signer in (stream.sender, stream.receiver), 'Only sender or receiver can balance a stream.')
+
+        outstanding_balance = self.calc_settlement(stream)
+        require(stream.closes is not None and stream.closes <= self.now, 'Stream has not closed yet.')
+        require(self.calc_claimable(stream, outstanding_balance) == outstanding_balance, 'Stream has outstanding balance.')
+
+        self.pay_stream(stream, outstanding_balance)
+        self.mark_finalized(stream)
+
+        return f"Finalized stream {stream_id}"
+
+    @in_decimal_context
+    def finalize_expired(self, signer: str, bucket: str, max_count: int):
+        require(max_count > 0, 'Max count must be greater than 0.')
+
+        head = self.close_bucket_heads.get(bucket, 0)
+        tail = self.close_bucket_tails.get(bucket, 0)
+
+        require(head < tail, 'No streams in this bucket.')
+
+        end = min(head + max_count, tail)
+        kept = []
+        finalized = 0
+
+        for i in range(head, end):
+            stream_id = self.close_buckets.pop((bucket, i))
+            stream = self.load_stream(stream_id)
+
+            if stream.status != STREAM_ACTIVE or str(stream.closes)[:13] != bucket:
+                continue
+
+            if stream.closes > self.now:
+                kept.append(stream_id)
+                continue
+
+            outstanding_balance = self.calc_stream_outstanding(stream)
+
+            if outstanding_balance > 0:
+                claimable_amount = self.pay_stream(stream, outstanding_balance)
+
+                if claimable_amount < outstanding_balance:
+                    kept.append(stream_id)
+                    continue
+
+            self.mark_finalized(stream)
+            finalized += 1
+
+        self.close_bucket_heads[bucket] = end
+
+        for stream_id in kept:
+            self.add_to_close_bucket(stream_id, bucket=bucket)
+
+        return f"Finalized {finalized} streams"
+
+    @in_decimal_context
+    def forfeit_stream(self, signer: str, stream_id: str) -> str:
+        stream = self.load_stream(stream_id)
+
+        require(stream.status == STREAM_ACTIVE, 'Stream is not active.')
+        require(signer == stream.receiver, 'Only receiver can forfeit a stream.')
+
+        self.record_stream_stats(-1, -self.calc_active_rate(stream.rate, stream.period), stream.claimed - self.calc_committed(stream), 0)
+
+        stream.status = STREAM_FORFEIT
+        stream.closes = self.now
+
+        if stream.deposit:
+            self.credit(stream.sender, stream.deposit)
+            stream.deposit = 0
+
+        return f"Forfeit stream {stream_id}"
+
+    @in_decimal_context
+    def merge_streams(self, signer: str, stream_ids: list):
+        require(len(stream_ids) > 1, 'At least two streams are needed to merge.')
+        require(len(set(stream_ids)) == len(stream_ids), 'Streams can only be merged once.')
+
+        loaded = []
+        for stream_id in stream_ids:
+            stream = self.load_stream(stream_id)
+            require(stream.status == STREAM_ACTIVE, 'You can only merge active streams.')
+            loaded.append(stream)
+
+        sender = loaded[0].sender
+        receiver = loaded[0].receiver
+        escrow = loaded[0].deposit is not None
+
+        require(signer in (sender, receiver), 'Only sender or receiver can merge streams.')
+
+        for stream in loaded:
+            require(stream.sender == sender and stream.receiver == receiver, 'Streams must have the same sender and receiver.')
+            require((stream.deposit is not None) == escrow, 'Cannot merge escrow and non-escrow streams.')
+            require(stream.period is None, 'Subscriptions cannot be merged.')
+
+        begins = min(stream.begins for stream in loaded)
+        closes = max(stream.closes for stream in loaded)
+
+        require(begins < closes, 'Stream cannot begin after the close date.')
+
+        # The merged stream does not depend on settlement, so it is validated before anything is paid
+        schedule = self.merge_schedules(begins, closes, loaded)
+        rate = schedule[-1][1]
+        require(rate > 0, 'Rate must be greater than 0.')
+
+        if len(schedule) == 1:
+            schedule = None
+
+        for stream in loaded:
+            if self.now > stream.begins:
+                outstanding_balance = self.calc_stream_outstanding(stream)
+
+                if outstanding_balance > 0:
+                    self.pay_stream(stream, outstanding_balance)
+
+        merged_id = self.perform_create_stream(sender, receiver, rate, begins, closes, schedule)
+        merged = self.streams[merged_id]
+        merged.claimed = sum(stream.claimed for stream in loaded)
+        if escrow:
+            merged.deposit = sum(stream.deposit for stream in loaded)
+
+        for stream in loaded:
+            total = self.calc_total_accrued(stream.begins, stream.closes, stream.rate, stream.schedule)
+            self.record_stream_stats(-1, -stream.rate, -total, 0)
+
+            if escrow:
+                stream.deposit = 0
+
+            stream.status = STREAM_MERGED
+            stream.merged_into = merged_id
+
+        return merged_id
+
+    def merge_schedules(self, begins, closes, merged: list) -> list:
+        end = seconds_between(begins, closes)
+        offsets = set()
+
+        for stream in merged:
+            start = seconds_between(begins, stream.begins)
+            offsets.add(start)
+            offsets.add(seconds_between(begins, stream.closes))
+
+            if stream.schedule is not None:
+                for segment in stream.schedule:
+                    offsets.add(start + segment[0])
+
+        schedule = []
+
+        for offset in sorted(offsets):
+            if offset >= end:
+                continue
+
+            rate = 0
+            accrued = 0
+            for stream in merged:
+                rate += self.calc_rate_at(stream, begins, offset)
+                accrued += self.calc_accrued_at(stream, begins, offset)
+
+            schedule.append([offset, rate, accrued])
+
+        return schedule
+
+    def calc_rate_at(self, stream: StreamRecord, begins, elapsed: int) -> Any:
+        local = elapsed - seconds_between(begins, stream.begins)
+
+        if local < 0 or local >= seconds_between(stream.begins, stream.closes):
+            return 0
+
+        if stream.schedule is None:
+            return stream.rate
+
+        rate = 0
+        for offset, segment_rate, _ in stream.schedule:
+            if offset <= local:
+                rate = segment_rate
+        return rate
+
+    def calc_accrued_at(self, stream: StreamRecord, begins, elapsed: int) -> Any:
+        local = min(elapsed - seconds_between(begins, stream.begins), seconds_between(stream.begins, stream.closes))
+
+        if local <= 0:
+            return 0
+
+        if stream.schedule is None:
+            return stream.rate * local
+
+        return self.calc_scheduled_accrued(stream.schedule, local)
+
+    def load_stream(self, stream_id: str) -> StreamRecord:
+        stream = self.streams.get(stream_id)
+        require(stream is not None, 'Stream does not exist.')
+        return stream
+
+    def copy_stream(self, stream: StreamRecord) -> StreamRecord:
+        trial = StreamRecord.__new__(StreamRecord)
+        for slot in StreamRecord.__slots__:
+            setattr(trial, slot, getattr(stream, slot))
+        return trial
+
+    # The checks settle_stream makes before paying out
+    def calc_settlement(self, stream: StreamRecord) -> Any:
+        require(self.now > stream.begins, 'Stream has not started yet.')
+
+        outstanding_balance = self.calc_stream_outstanding(stream)
+
+        require(outstanding_balance > 0, 'No amount due on this stream.')
+
+        return outstanding_balance
+
+    def calc_claimable(self, stream: StreamRecord, outstanding_balance: Any) -> Any:
+        available = self.balances.get(stream.sender, 0) if stream.deposit is None else stream.deposit
+        return outstanding_balance if outstanding_balance < available else available
+
+    def pay_stream(self, stream: StreamRecord, outstanding_balance: Any) -> Any:
+        claimable_amount = self.calc_claimable(stream, outstanding_balance)
+
+        if stream.deposit is None:
+            self.debit(stream.sender, claimable_amount)
+        else:
+            stream.deposit -= claimable_amount
+
+        self.credit(stream.receiver, claimable_amount)
+        stream.claimed += claimable_amount
+        self.record_stream_stats(0, 0, claimable_amount if stream.closes is None else 0, claimable_amount)
+
+        return claimable_amount
+
+    def mark_finalized(self, stream: StreamRecord):
+        stream.status = STREAM_FINALIZED
+        self.record_stream_stats(-1, -self.calc_active_rate(stream.rate, stream.period), 0, 0)
+
+    def set_close_time(self, stream: StreamRecord, closes: datetime.datetime):
+        old_total = self.calc_committed(stream)
+        new_total = self.calc_total_accrued(stream.begins, closes, stream.rate, stream.schedule, stream.period)
+
+        stream.closes = closes
+        self.record_stream_stats(0, 0, new_total - old_total, 0)
+
+    def record_stream_stats(self, active_count, active_rate, streamed, claimed):
+        stats = self.stream_stats
+        stats["active_count"] += active_count
+        stats["active_rate"] += active_rate
+        stats["total_streamed"] += streamed
+        stats["total_claimed"] += claimed
+
+    # How much the sender has to add to (or gets back from) the deposit if the stream closed at `closes`
+    def check_deposit(self, stream: StreamRecord, closes: datetime.datetime) -> Any:
+        required = self.calc_total_accrued(stream.begins, closes, stream.rate, stream.schedule) - stream.claimed
+        difference = required - stream.deposit
+
+        if difference > 0:
+            require(self.balances.get(stream.sender, 0) >= difference, 'Not enough coins to fund the stream.')
+
+        return difference
+
+    def rebalance_deposit(self, stream: StreamRecord, difference: Any):
+        if difference > 0:
+            self.debit(stream.sender, difference)
+        elif difference < 0:
+            self.credit(stream.sender, -difference)
+
+        stream.deposit += difference
+
+    def calc_close_time(self, begins: datetime.datetime, new_close_time: datetime.datetime) -> datetime.datetime:
+        if new_close_time < begins and self.now < begins:
+            return begins
+        if new_close_time <= self.now:
+            return self.now
+        return new_close_time
+
+    def add_to_close_bucket(self, stream_id: str, closes: Optional[datetime.datetime] = None, bucket: Optional[str] = None):
+        if bucket is None:
+            bucket = str(closes)[:13]
+
+        tail = self.close_bucket_tails.get(bucket, 0)
+        self.close_buckets[bucket, tail] = stream_id
+        self.close_bucket_tails[bucket] = tail + 1
+
+    def move_close_bucket(self, stream_id: str, old_closes: Optional[datetime.datetime], new_closes: datetime.datetime):
+        if old_closes is not None and str(old_closes)[:13] == str(new_closes)[:13]:
+            return
+
+        self.add_to_close_bucket(stream_id, new_closes)
+
+    def calc_stream_outstanding(self, stream: StreamRecord) -> Any:
+        if stream.period is not None:
+            claimable_end_point = self.now if stream.closes is None or self.now < stream.closes else stream.closes
+            return self.calc_subscription_accrued(stream.begins, stream.closes, stream.rate, stream.period, claimable_end_point) - stream.claimed
+
+        claimable_end_point = self.now if self.now < stream.closes else stream.closes
+        elapsed = seconds_between(stream.begins, claimable_end_point)
+
+        if stream.schedule is None:
+            return stream.rate * elapsed - stream.claimed
+
+        return self.calc_scheduled_accrued(stream.schedule, elapsed) - stream.claimed
+
+    def calc_scheduled_accrued(self, schedule: list, elapsed: int) -> Any:
+        low = 0
+        high = len(schedule) - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if schedule[mid][0] <= elapsed:
+                low = mid
+            else:
+                high = mid - 1
+
+        offset, rate, accrued = schedule[low]
+        return accrued + rate * (elapsed - offset)
+
+    def calc_subscription_accrued(self, begins, closes, amount, period: int, end) -> Any:
+        if end < begins:
+            return 0
+
+        periods = seconds_between(begins, end) // period + 1
+
+        if closes is not None:
+            periods = min(periods, (seconds_between(begins, closes) + period - 1) // period)
+
+        return amount * periods
+
+    def calc_period_end(self, begins, period: int):
+        if self.now < begins:
+            return begins
+
+        periods = seconds_between(begins, self.now) // period + 1
+        return begins + datetime.timedelta(seconds=period * periods)
+
+    def calc_active_rate(self, rate, period) -> Any:
+        return 0 if period is not None else rate
+
+    def calc_committed(self, stream: StreamRecord) -> Any:
+        if stream.closes is None:
+            return stream.claimed
+
+        return self.calc_total_accrued(stream.begins, stream.closes, stream.rate, stream.schedule, stream.period)
+
+    def calc_total_accrued(self, begins, closes, rate, schedule, period=None) -> Any:
+        if period is not None:
+            return self.calc_subscription_accrued(begins, closes, rate, period, closes)
+
+        seconds = seconds_between(begins, closes)
+
+        if schedule is None:
+            return rate * seconds
+
+        return self.calc_scheduled_accrued(schedule, seconds)
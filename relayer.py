@@ -0,0 +1,180 @@
+"""
+Asyncio relayer for XSC003 stream permits.
+
+Signs `create_stream_from_permit` payloads in a process pool and submits them
+to a node with bounded concurrency. Permits whose deadline has passed are
+dropped before they are submitted, since the contract would reject them.
+
+The node is anything exposing an async `submit(contract, function, kwargs)`
+coroutine, which makes it easy to run the relayer against a local stand-in.
+"""
+import asyncio
+import datetime
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional
+
+from xian_py.wallet import Wallet
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+RELAY_SUBMITTED = "submitted"
+RELAY_EXPIRED = "expired"
+RELAY_FAILED = "failed"
+
+
+# Naive UTC, comparable with the contract's `now` (datetime.utcnow is deprecated)
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+@dataclass
+class StreamPermit:
+    sender: str
+    receiver: str
+    rate: Any
+    begins: str
+    closes: str
+    deadline: str
+    signature: Optional[str] = None
+
+    def deadline_time(self) -> datetime.datetime:
+        return datetime.datetime.strptime(self.deadline, TIME_FORMAT)
+
+    def kwargs(self) -> dict:
+        return {
+            "sender": self.sender,
+            "receiver": self.receiver,
+            "rate": self.rate,
+            "begins": self.begins,
+            "closes": self.closes,
+            "deadline": self.deadline,
+            "signature": self.signature,
+        }
+
+
+@dataclass
+class RelayResult:
+    permit: StreamPermit
+    status: str
+    result: Any = None
+
+
+# Mirrors construct_stream_permit_msg in token_xsc003.py
+def construct_stream_permit_msg(sender: str, receiver: str, rate: Any, begins: str, closes: str, deadline: str, contract: str, chain_id: str) -> str:
+    return f"{sender}:{receiver}:{rate}:{begins}:{closes}:{deadline}:{contract}:{chain_id}"
+
+
+# Runs inside the process pool, so it must stay a picklable top-level function
+def sign_messages(private_key: str, messages: List[str]) -> List[str]:
+    wallet = Wallet(private_key)
+    return [wallet.sign_msg(msg) for msg in messages]
+
+
+class XianNode:
+    """Adapts a blocking `xian_py.Xian` client to the relayer's node interface."""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def submit(self, contract: str, function: str, kwargs: dict) -> Any:
+        return await asyncio.to_thread(self.client.send_tx, contract, function, kwargs)
+
+
+class StreamRelayer:
+    def __init__(self, node, private_key: str, contract: str, chain_id: str,
+                 batch_size: int = 64, max_in_flight: int = 16, workers: Optional[int] = None,
+                 deadline_margin: int = 0, clock: Callable[[], datetime.datetime] = utcnow):
+        assert batch_size > 0, 'Batch size must be greater than 0.'
+        assert max_in_flight > 0, 'Concurrency must be greater than 0.'
+
+        self.node = node
+        self.private_key = private_key
+        self.sender = Wallet(private_key).public_key
+        self.contract = contract
+        self.chain_id = chain_id
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.workers = workers
+        self.deadline_margin = datetime.timedelta(seconds=deadline_margin)
+        self.clock = clock
+        self.executor = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def permit_msg(self, permit: StreamPermit) -> str:
+        return construct_stream_permit_msg(
+            permit.sender, permit.receiver, permit.rate, permit.begins,
+            permit.closes, permit.deadline, self.contract, self.chain_id
+        )
+
+    # Deadlines are compared against the contract's `now`, which is UTC block time
+    def is_expired(self, permit: StreamPermit) -> bool:
+        return permit.deadline_time() <= self.clock() + self.deadline_margin
+
+    # Orders permits by deadline, soonest first, and splits off the expired ones
+    def schedule(self, permits: List[StreamPermit]):
+        heap = [(permit.deadline_time(), i, permit) for i, permit in enumerate(permits)]
+        heapq.heapify(heap)
+
+        expired = []
+        live = []
+        while heap:
+            permit = heapq.heappop(heap)[2]
+            if self.is_expired(permit):
+                expired.append(permit)
+            else:
+                live.append(permit)
+
+        return live, expired
+
+    async def relay(self, permits: List[StreamPermit]) -> List[RelayResult]:
+        for permit in permits:
+            assert permit.sender == self.sender, 'Permit sender does not match the signing wallet.'
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        live, expired = self.schedule(permits)
+        results = [RelayResult(permit, RELAY_EXPIRED) for permit in expired]
+
+        batches = [live[i:i + self.batch_size] for i in range(0, len(live), self.batch_size)]
+
+        # Queue every batch on the pool up front so signing of later batches
+        # overlaps with submission of earlier ones
+        signing = [
+            loop.run_in_executor(self.executor, sign_messages, self.private_key, [self.permit_msg(p) for p in batch])
+            for batch in batches
+        ]
+
+        submissions = []
+        for batch, signed in zip(batches, signing):
+            for permit, signature in zip(batch, await signed):
+                permit.signature = signature
+                submissions.append(asyncio.create_task(self.submit(permit, semaphore)))
+
+        results.extend(await asyncio.gather(*submissions))
+        return results
+
+    async def submit(self, permit: StreamPermit, semaphore: asyncio.Semaphore) -> RelayResult:
+        async with semaphore:
+            # The deadline may have passed while the permit waited for a slot
+            if self.is_expired(permit):
+                return RelayResult(permit, RELAY_EXPIRED)
+            try:
+                result = await self.node.submit(self.contract, "create_stream_from_permit", permit.kwargs())
+            except Exception as e:
+                return RelayResult(permit, RELAY_FAILED, e)
+            return RelayResult(permit, RELAY_SUBMITTED, result)
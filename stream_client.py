@@ -0,0 +1,174 @@
+"""
+Client-side cache for XSC003 stream state.
+
+Keeps an LRU cache of `streams[stream_id, *]` fields and `balances[address]`
+read from a node, and computes outstanding amounts locally from the cached
+fields so repeated reads do not hit the node. Entries are invalidated from the
+state keys each block changed, which the caller feeds in with `apply_block`.
+
+`get_state(contract, variable, *keys)` is the only node access; it matches
+`xian_py.Xian.get_state`.
+"""
+import datetime
+import decimal
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, Optional
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+SENDER_KEY = "sender"
+RECEIVER_KEY = "receiver"
+STATUS_KEY = "status"
+BEGIN_KEY = "begins"
+CLOSE_KEY = "closes"
+RATE_KEY = "rate"
+CLAIMED_KEY = "claimed"
+SCHEDULE_KEY = "schedule"
+PERIOD_KEY = "period"
+DEPOSIT_KEY = "deposit"
+STREAM_ACTIVE = "active"
+
+STREAM_FIELDS = (STATUS_KEY, SENDER_KEY, RECEIVER_KEY, BEGIN_KEY, CLOSE_KEY, RATE_KEY, CLAIMED_KEY, SCHEDULE_KEY, PERIOD_KEY, DEPOSIT_KEY)
+
+# Stands in for "no value" in the cache, since None is a valid cached result
+MISSING = object()
+
+
+# The current UTC time as a naive datetime, the form cached times are compared in
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def to_datetime(value: Any) -> datetime.datetime:
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, dict) and "__time__" in value:
+        return datetime.datetime(*value["__time__"])
+    if isinstance(value, str):
+        return datetime.datetime.strptime(value, TIME_FORMAT)
+    # contracting.stdlib.bridge.time.Datetime
+    return value._datetime
+
+
+def to_number(value: Any) -> Any:
+    if isinstance(value, dict) and "__fixed__" in value:
+        return decimal.Decimal(value["__fixed__"])
+    return 0 if value is None else value
+
+
+def seconds_between(start: datetime.datetime, end: datetime.datetime) -> int:
+    return int((end - start).total_seconds())
+
+
+# Mirrors calc_outstanding_balance / calc_scheduled_outstanding / calc_subscription_outstanding
+# in token_xsc003.py
+def calc_outstanding_balance(stream: dict, at: datetime.datetime) -> Any:
+    begins = to_datetime(stream[BEGIN_KEY])
+    closes = None if stream[CLOSE_KEY] is None else to_datetime(stream[CLOSE_KEY])
+    claimed = to_number(stream[CLAIMED_KEY])
+
+    claimable_end_point = at if closes is None or at < closes else closes
+
+    period = stream.get(PERIOD_KEY)
+    if period:
+        periods = seconds_between(begins, claimable_end_point) // period + 1
+        if closes is not None:
+            periods = min(periods, (seconds_between(begins, closes) + period - 1) // period)
+        return to_number(stream[RATE_KEY]) * periods - claimed
+
+    elapsed = seconds_between(begins, claimable_end_point)
+
+    schedule = stream.get(SCHEDULE_KEY)
+    if not schedule:
+        return to_number(stream[RATE_KEY]) * elapsed - claimed
+
+    low = 0
+    high = len(schedule) - 1
+    while low < high:
+        mid = (low + high + 1) // 2
+        if schedule[mid][0] <= elapsed:
+            low = mid
+        else:
+            high = mid - 1
+
+    offset, rate, accrued = schedule[low]
+    return to_number(accrued) + to_number(rate) * (elapsed - offset) - claimed
+
+
+class StreamCache:
+    def __init__(self, get_state: Callable[..., Any], contract: str = "currency", max_entries: int = 10_000):
+        assert max_entries > 0, 'Cache must hold at least one entry.'
+
+        self.get_state = get_state
+        self.contract = contract
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.height = None
+        self.hits = 0
+        self.misses = 0
+
+    def state_key(self, variable: str, *keys: str) -> str:
+        return ":".join((f"{self.contract}.{variable}",) + tuple(str(k) for k in keys))
+
+    def get(self, variable: str, *keys: str) -> Any:
+        key = self.state_key(variable, *keys)
+        value = self.entries.get(key, MISSING)
+
+        if value is not MISSING:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = self.get_state(self.contract, variable, *keys)
+        self.entries[key] = value
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return value
+
+    def stream(self, stream_id: str) -> Optional[dict]:
+        if not self.get("streams", stream_id, STATUS_KEY):
+            return None
+        return {field: self.get("streams", stream_id, field) for field in STREAM_FIELDS}
+
+    def balance_of(self, address: str) -> Any:
+        return to_number(self.get("balances", address))
+
+    # Amount a balance_stream call would pay out at `at` (UTC, like the contract's `now`),
+    # computed from cached state
+    def outstanding(self, stream_id: str, at: Optional[datetime.datetime] = None) -> Any:
+        stream = self.stream(stream_id)
+        if stream is None or stream[STATUS_KEY] != STREAM_ACTIVE:
+            return 0
+
+        at = utcnow() if at is None else at
+        if at <= to_datetime(stream[BEGIN_KEY]):
+            return 0
+
+        amount_due = calc_outstanding_balance(stream, at)
+        if amount_due <= 0:
+            return 0
+
+        # Escrow streams pay from their deposit rather than the sender's balance
+        if stream[DEPOSIT_KEY] is not None:
+            available = to_number(stream[DEPOSIT_KEY])
+        else:
+            available = self.balance_of(stream[SENDER_KEY])
+        return amount_due if amount_due < available else available
+
+    # Drops every cached entry written in block `height`. `changed_keys` are full
+    # state keys such as "currency.streams:<id>:claimed" or "currency.balances:<address>"
+    # If blocks were skipped, their changes are unknown, so the whole cache is dropped
+    def apply_block(self, height: int, changed_keys: Iterable[str]):
+        if self.height is not None and height <= self.height:
+            return
+        if self.height is not None and height != self.height + 1:
+            self.entries.clear()
+        self.height = height
+
+        for key in changed_keys:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.height = None
@@ -0,0 +1,263 @@
+# XST003 / Shared Streaming Engine
+# Streams any XSC001 token through `transfer_from`, so tokens do not need to
+# carry their own copy of the streaming code.
+# Senders approve this contract on the token for the amount they want to stream.
+# Streams are keyed by (token, stream_id).
+# Supports flat-rate streams and permits only; escrow, schedule, subscription and
+# merged streams, close buckets and stream statistics live in token_xsc003.py.
+
+permits = Hash()
+streams = Hash()
+
+token_interface = [
+    importlib.Func('transfer_from', args=('amount', 'to', 'main_account')),
+    importlib.Func('balance_of', args=('address',)),
+    importlib.Func('allowance', args=('owner', 'spender')),
+]
+
+SENDER_KEY = "sender"
+RECEIVER_KEY = "receiver"
+STATUS_KEY = "status"
+BEGIN_KEY = "begins"
+CLOSE_KEY = "closes"
+RATE_KEY = "rate"
+CLAIMED_KEY = "claimed"
+STREAM_ACTIVE = "active"
+STREAM_FINALIZED = "finalized"
+STREAM_FORFEIT = "forfeit"
+
+
+# Creates a new stream of `token` to a receiver from ctx.caller
+# Stream can begin at any point in past / present / future
+# Wrapper for perform_create_stream
+@export
+def create_stream(token: str, receiver: str, rate: float, begins: str, closes: str):
+    begins = strptime_ymdhms(begins)
+    closes = strptime_ymdhms(closes)
+    sender = ctx.caller
+
+    stream_id = perform_create_stream(token, sender, receiver, rate, begins, closes)
+    return stream_id
+
+
+# Internal function used to create a stream from a permit or from a direct call from the sender
+def perform_create_stream(token: str, sender: str, receiver: str, rate: float, begins: str, closes: str):
+    assert importlib.enforce_interface(importlib.import_module(token), token_interface), 'Token does not implement XSC001 with allowance.'
+
+    stream_id = hashlib.sha3(f"{token}:{sender}:{receiver}:{begins}:{closes}:{rate}")
+
+    assert streams[token, stream_id, STATUS_KEY] is None, 'Stream already exists.'
+    assert begins < closes, 'Stream cannot begin after the close date.'
+    assert rate > 0, 'Rate must be greater than 0.'
+
+    streams[token, stream_id, STATUS_KEY] = STREAM_ACTIVE
+    streams[token, stream_id, BEGIN_KEY] = begins
+    streams[token, stream_id, CLOSE_KEY] = closes
+    streams[token, stream_id, RECEIVER_KEY] = receiver
+    streams[token, stream_id, SENDER_KEY] = sender
+    streams[token, stream_id, RATE_KEY] = rate
+    streams[token, stream_id, CLAIMED_KEY] = 0
+
+    return stream_id
+
+
+# Creates a payment stream from a valid signature of a permit message
+# Wrapper for perform_create_stream
+@export
+def create_stream_from_permit(token: str, sender: str, receiver: str, rate: float, begins: str, closes: str, deadline: str, signature: str):
+    begins = strptime_ymdhms(begins)
+    closes = strptime_ymdhms(closes)
+    deadline = strptime_ymdhms(deadline)
+
+    assert now < deadline, 'Permit has expired.'
+    permit_msg = construct_stream_permit_msg(token, sender, receiver, rate, begins, closes, deadline)
+    permit_hash = hashlib.sha3(permit_msg)
+
+    assert permits[permit_hash] is None, 'Permit can only be used once.'
+    assert crypto.verify(sender, permit_msg, signature), 'Invalid signature.'
+
+    permits[permit_hash] = True
+
+    return perform_create_stream(token, sender, receiver, rate, begins, closes)
+
+
+# Moves balance due from stream from sender to receiver through the token's transfer_from.
+# Called by `sender` or `receiver`
+@export
+def balance_stream(token: str, stream_id: str):
+    stream = load_stream(token, stream_id)
+
+    assert stream[STATUS_KEY] == STREAM_ACTIVE, 'You can only balance active streams.'
+    assert ctx.caller in [stream[SENDER_KEY], stream[RECEIVER_KEY]], 'Only sender or receiver can balance a stream.'
+
+    claimable_amount = settle_stream(token, stream)
+
+    streams[token, stream_id, CLAIMED_KEY] = stream[CLAIMED_KEY]
+
+    return f"Claimed {claimable_amount} tokens from stream"
+
+
+# Sets a stream to expire at some point greater than or equal to the current time.
+# If the new closes time is in the past, the stream is closed immediately
+# If the new close time < begins, the stream is closed at begin time <invalidated>
+# Called by `sender`
+@export
+def change_close_time(token: str, stream_id: str, new_close_time: str):
+    new_close_time = strptime_ymdhms(new_close_time)
+
+    status = streams[token, stream_id, STATUS_KEY]
+
+    assert status, 'Stream does not exist.'
+    assert status == STREAM_ACTIVE, 'Stream is not active.'
+    assert ctx.caller == streams[token, stream_id, SENDER_KEY], 'Only sender can extend the close time of a stream.'
+
+    closes = calc_close_time(streams[token, stream_id, BEGIN_KEY], new_close_time)
+    streams[token, stream_id, CLOSE_KEY] = closes
+
+    return f"Changed close time of stream to {closes}"
+
+
+# Set the stream inactive.
+# A stream must be balanced before it can be finalized.
+# Closes must be <= now
+# Called by : `sender` or `receiver`
+@export
+def finalize_stream(token: str, stream_id: str):
+    stream = load_stream(token, stream_id)
+
+    assert stream[STATUS_KEY] == STREAM_ACTIVE, 'Stream is not active.'
+    assert ctx.caller in [stream[SENDER_KEY], stream[RECEIVER_KEY]], 'Only sender or receiver can finalize a stream.'
+
+    assert_finalizable(stream)
+
+    streams[token, stream_id, STATUS_KEY] = STREAM_FINALIZED
+
+    return f"Finalized stream {stream_id}"
+
+
+# Convenience method to close a stream, balance it and finalize it
+# Called by `sender`
+@export
+def close_balance_finalize(token: str, stream_id: str):
+    stream = load_stream(token, stream_id)
+
+    assert stream[STATUS_KEY] == STREAM_ACTIVE, 'Stream is not active.'
+    assert ctx.caller == stream[SENDER_KEY], 'Only sender can extend the close time of a stream.'
+
+    stream[CLOSE_KEY] = calc_close_time(stream[BEGIN_KEY], now)
+    settle_stream(token, stream)
+    assert_finalizable(stream)
+
+    streams[token, stream_id, CLOSE_KEY] = stream[CLOSE_KEY]
+    streams[token, stream_id, CLAIMED_KEY] = stream[CLAIMED_KEY]
+    streams[token, stream_id, STATUS_KEY] = STREAM_FINALIZED
+
+    return f"Finalized stream {stream_id}"
+
+
+# Convenience method to balance a stream and finalize it
+# Called by `receiver` or `sender`
+@export
+def balance_finalize(token: str, stream_id: str):
+    stream = load_stream(token, stream_id)
+
+    assert stream[STATUS_KEY] == STREAM_ACTIVE, 'You can only balance active streams.'
+    assert ctx.caller in [stream[SENDER_KEY], stream[RECEIVER_KEY]], 'Only sender or receiver can balance a stream.'
+
+    settle_stream(token, stream)
+    assert_finalizable(stream)
+
+    streams[token, stream_id, CLAIMED_KEY] = stream[CLAIMED_KEY]
+    streams[token, stream_id, STATUS_KEY] = STREAM_FINALIZED
+
+    return f"Finalized stream {stream_id}"
+
+
+# Forfeit a stream to the sender
+# Called by `receiver`
+@export
+def forfeit_stream(token: str, stream_id: str) -> str:
+    status = streams[token, stream_id, STATUS_KEY]
+
+    assert status, 'Stream does not exist.'
+    assert status == STREAM_ACTIVE, 'Stream is not active.'
+    assert ctx.caller == streams[token, stream_id, RECEIVER_KEY], 'Only receiver can forfeit a stream.'
+
+    streams[token, stream_id, STATUS_KEY] = STREAM_FORFEIT
+    streams[token, stream_id, CLOSE_KEY] = now
+
+    return f"Forfeit stream {stream_id}"
+
+
+def load_stream(token: str, stream_id: str) -> dict:
+    status = streams[token, stream_id, STATUS_KEY]
+
+    assert status, 'Stream does not exist.'
+
+    return {
+        STATUS_KEY: status,
+        SENDER_KEY: streams[token, stream_id, SENDER_KEY],
+        RECEIVER_KEY: streams[token, stream_id, RECEIVER_KEY],
+        BEGIN_KEY: streams[token, stream_id, BEGIN_KEY],
+        CLOSE_KEY: streams[token, stream_id, CLOSE_KEY],
+        RATE_KEY: streams[token, stream_id, RATE_KEY],
+        CLAIMED_KEY: streams[token, stream_id, CLAIMED_KEY],
+    }
+
+
+# Pays out what is due on a loaded stream, capped by the sender's token balance and
+# by what the sender has approved this contract to spend, so a short approval pays
+# out what it covers instead of failing the transfer.
+def settle_stream(token: str, stream: dict) -> float:
+    assert now > stream[BEGIN_KEY], 'Stream has not started yet.'
+
+    outstanding_balance = calc_outstanding_balance(stream[BEGIN_KEY], stream[CLOSE_KEY], stream[RATE_KEY], stream[CLAIMED_KEY])
+
+    assert outstanding_balance > 0, 'No amount due on this stream.'
+
+    t = importlib.import_module(token)
+    available = t.balance_of(address=stream[SENDER_KEY])
+    approved = t.allowance(owner=stream[SENDER_KEY], spender=ctx.this)
+    if approved < available:
+        available = approved
+
+    claimable_amount = outstanding_balance if outstanding_balance < available else available
+
+    if claimable_amount > 0:
+        t.transfer_from(amount=claimable_amount, to=stream[RECEIVER_KEY], main_account=stream[SENDER_KEY])
+
+    stream[CLAIMED_KEY] += claimable_amount
+
+    return claimable_amount
+
+
+def assert_finalizable(stream: dict):
+    assert stream[CLOSE_KEY] <= now, 'Stream has not closed yet.'
+
+    outstanding_balance = calc_outstanding_balance(stream[BEGIN_KEY], stream[CLOSE_KEY], stream[RATE_KEY], stream[CLAIMED_KEY])
+
+    assert outstanding_balance == 0, 'Stream has outstanding balance.'
+
+
+def calc_close_time(begins: datetime.datetime, new_close_time: datetime.datetime) -> datetime.datetime:
+    if new_close_time < begins and now < begins:
+        return begins
+    if new_close_time <= now:
+        return now
+    return new_close_time
+
+
+def calc_outstanding_balance(begins: str, closes: str, rate: float, claimed: float) -> float:
+    claimable_end_point = now if now < closes else closes
+    claimable_period = claimable_end_point - begins
+    claimable_seconds = claimable_period.seconds
+    amount_due = (rate * claimable_seconds) - claimed
+    return amount_due
+
+
+def construct_stream_permit_msg(token: str, sender: str, receiver: str, rate: float, begins: str, closes: str, deadline: str) -> str:
+    return f"{token}:{sender}:{receiver}:{rate}:{begins}:{closes}:{deadline}:{ctx.this}:{chain_id}"
+
+
+def strptime_ymdhms(date_string: str) -> datetime.datetime:
+    return datetime.datetime.strptime(date_string, '%Y-%m-%d %H:%M:%S')
@@ -1,5 +1,6 @@
 import unittest
 from contracting.stdlib.bridge.time import Datetime
+from contracting.stdlib.bridge.decimal import ContractingDecimal
 from contracting.client import ContractingClient
 from xian_py.wallet import Wallet
 import datetime
@@ -29,6 +30,12 @@ class TestCurrencyContract(unittest.TestCase):
         }
         self.client.flush()
 
+    # Stream IDs queued in a close-time bucket, from head to tail
+    def close_bucket(self, bucket):
+        head = self.currency.close_bucket_heads[bucket]
+        tail = self.currency.close_bucket_tails[bucket]
+        return [self.currency.close_buckets[bucket, i] for i in range(head, tail)]
+
     def test_balance_of(self):
         # GIVEN
         receiver = 'receiver_account'
@@ -57,6 +64,25 @@ class TestCurrencyContract(unittest.TestCase):
         self.assertEqual(bob_balance, 100)
         self.assertEqual(sys_balance, 999_900)
 
+    def test_supply_and_holder_count(self):
+        # GIVEN the initial setup
+        # THEN the supply and holder count should be seeded
+        self.assertEqual(self.currency.get_total_supply(signer="sys"), 1_000_000)
+        self.assertEqual(self.currency.get_holder_count(signer="sys"), 1)
+
+        # WHEN coins are sent to new holders
+        self.currency.transfer(amount=100, to="bob", signer="sys")
+        self.currency.approve(amount=50, to="bob", signer="sys")
+        self.currency.transfer_from(amount=50, to="eve", main_account="sys", signer="bob")
+        # THEN the holder count should grow and the supply stay the same
+        self.assertEqual(self.currency.get_holder_count(signer="sys"), 3)
+        self.assertEqual(self.currency.get_total_supply(signer="sys"), 1_000_000)
+
+        # WHEN a holder sends away their whole balance
+        self.currency.transfer(amount=100, to="eve", signer="bob")
+        # THEN they should no longer be counted
+        self.assertEqual(self.currency.get_holder_count(signer="sys"), 2)
+
     def test_change_metadata(self):
         # GIVEN a non-operator trying to change metadata
         with self.assertRaises(Exception):
@@ -73,9 +99,11 @@ class TestCurrencyContract(unittest.TestCase):
         # GIVEN an approval setup
         self.currency.approve(amount=500, to="eve", signer="sys")
         # WHEN checking the allowance
-        allowance = self.currency.balances["sys", "eve"]
-        # THEN the allowance should be set correctly
+        allowance = self.currency.allowances["sys", "eve"]
+        # THEN the allowance should be set correctly, separately from balances
         self.assertEqual(allowance, 500)
+        self.assertEqual(self.currency.allowance(owner="sys", spender="eve", signer="sys"), 500)
+        self.assertEqual(self.currency.balances["sys", "eve"], 0)
 
     def test_transfer_from_without_approval(self):
         # GIVEN an attempt to transfer without approval
@@ -95,12 +123,76 @@ class TestCurrencyContract(unittest.TestCase):
         )
         bob_balance = self.currency.balances["bob"]
         sys_balance = self.currency.balances["sys"]
-        remaining_allowance = self.currency.balances["sys", "bob"]
+        remaining_allowance = self.currency.allowances["sys", "bob"]
         # THEN the balances and allowance should reflect the transfer
         self.assertEqual(bob_balance, 100)
         self.assertEqual(sys_balance, 999_900)
         self.assertEqual(remaining_allowance, 100)
 
+    def test_transfer_many(self):
+        # GIVEN a batch of recipients
+        recipients = ["bob", "eve", "carol"]
+        amounts = [100, 200, 300]
+        # WHEN the batch is sent
+        self.currency.transfer_many(recipients=recipients, amounts=amounts, signer="sys")
+        # THEN each recipient should be credited and the sender debited once for the total
+        self.assertEqual(self.currency.balances["bob"], 100)
+        self.assertEqual(self.currency.balances["eve"], 200)
+        self.assertEqual(self.currency.balances["carol"], 300)
+        self.assertEqual(self.currency.balances["sys"], 999_400)
+        self.assertEqual(self.currency.get_holder_count(signer="sys"), 4)
+
+    def test_transfer_many_with_fractional_amounts(self):
+        # GIVEN fractional amounts, which reach the contract as floats inside the list
+        recipients = ["bob", "eve"]
+        amounts = [0.1, 0.2]
+        # WHEN the batch is sent
+        self.currency.transfer_many(recipients=recipients, amounts=amounts, signer="sys")
+        # THEN the sender's debit equals the sum of the credits, with no float error
+        self.assertEqual(self.currency.balances["bob"], ContractingDecimal('0.1'))
+        self.assertEqual(self.currency.balances["eve"], ContractingDecimal('0.2'))
+        self.assertEqual(self.currency.balances["sys"], ContractingDecimal('999999.7'))
+        self.assertEqual(1_000_000 - self.currency.balances["sys"], self.currency.balances["bob"] + self.currency.balances["eve"])
+
+    def test_transfer_many_fails_if_total_exceeds_balance(self):
+        # GIVEN a batch whose total is more than the sender holds
+        self.currency.transfer(amount=100, to="bob", signer="sys")
+        # WHEN the batch is sent
+        # THEN it should fail without crediting anyone
+        with self.assertRaises(AssertionError):
+            self.currency.transfer_many(recipients=["eve", "carol"], amounts=[60, 60], signer="bob")
+        with self.assertRaises(AssertionError):
+            self.currency.transfer_many(recipients=["eve", "carol"], amounts=[60], signer="bob")
+        with self.assertRaises(AssertionError):
+            self.currency.transfer_many(recipients=["eve", "carol"], amounts=[60, -10], signer="bob")
+        self.assertEqual(self.currency.balances["eve"], 0)
+        self.assertEqual(self.currency.balances["bob"], 100)
+
+    def test_transfer_from_many(self):
+        # GIVEN an approval that covers the batch
+        self.currency.approve(amount=500, to="bob", signer="sys")
+        # WHEN the spender sends a batch
+        self.currency.transfer_from_many(recipients=["eve", "carol"], amounts=[100, 200], main_account="sys", signer="bob")
+        # THEN the allowance and balances should reflect the total
+        self.assertEqual(self.currency.balances["eve"], 100)
+        self.assertEqual(self.currency.balances["carol"], 200)
+        self.assertEqual(self.currency.balances["sys"], 999_700)
+        self.assertEqual(self.currency.allowances["sys", "bob"], 200)
+        # WHEN the batch exceeds the remaining allowance
+        # THEN it should fail
+        with self.assertRaises(AssertionError):
+            self.currency.transfer_from_many(recipients=["eve", "carol"], amounts=[100, 200], main_account="sys", signer="bob")
+
+    def test_transfer_from_many_with_fractional_amounts(self):
+        # GIVEN an approval and a batch of fractional amounts
+        self.currency.approve(amount=1, to="bob", signer="sys")
+        # WHEN the spender sends the batch
+        self.currency.transfer_from_many(recipients=["eve", "carol"], amounts=[0.1, 0.2], main_account="sys", signer="bob")
+        # THEN the debit and the allowance both drop by exactly the sum of the credits
+        self.assertEqual(self.currency.balances["eve"] + self.currency.balances["carol"], ContractingDecimal('0.3'))
+        self.assertEqual(self.currency.balances["sys"], ContractingDecimal('999999.7'))
+        self.assertEqual(self.currency.allowances["sys", "bob"], ContractingDecimal('0.7'))
+
     # XST002 / Permit Tests
 
     # Helper Functions
@@ -213,6 +305,17 @@ class TestCurrencyContract(unittest.TestCase):
         self.assertEqual(self.currency.streams[stream_id, 'rate'], rate)
         self.assertEqual(self.currency.streams[stream_id, 'claimed'], 0)
 
+    def test_create_stream_sequential_ids(self):
+        # GIVEN two streams with identical parameters
+        begins = self.create_date(2023, 1, 1)
+        closes = self.create_date(2023, 12, 31)
+        # WHEN both are created
+        first = self.currency.create_stream(receiver='bob', rate=1, begins=str(begins), closes=str(closes), signer='alice')
+        second = self.currency.create_stream(receiver='bob', rate=1, begins=str(begins), closes=str(closes), signer='alice')
+        # THEN they should get consecutive compact IDs
+        self.assertEqual((first, second), ("1", "2"))
+        self.assertEqual(self.currency.streams[second, 'status'], 'active')
+
     def test_create_stream_invalid_dates(self):
         # GIVEN a stream creation setup with invalid date ranges
         sender = 'alice'
@@ -240,6 +343,183 @@ class TestCurrencyContract(unittest.TestCase):
         with self.assertRaises(Exception):
             self.currency.create_stream(receiver=receiver, rate=rate, begins=str(begins), closes=str(closes), signer=sender)
 
+    def test_create_schedule_stream_with_cliff(self):
+        # GIVEN a stream that pays nothing for a day, then 1 per second
+        sender = 'alice'
+        receiver = 'bob'
+        begins = Datetime(year=2023, month=1, day=1)
+        cliff = Datetime(year=2023, month=1, day=2)
+        closes = Datetime(year=2023, month=1, day=4)
+        self.currency.balances[sender] = 1_000_000
+
+        stream_id = self.currency.create_schedule_stream(receiver=receiver, begins=str(begins), closes=str(closes), starts=[str(begins), str(cliff)], rates=[0, 1], signer=sender)
+
+        # WHEN the stream is balanced before the cliff
+        # THEN nothing should be due
+        with self.assertRaises(AssertionError) as context:
+            self.currency.balance_stream(stream_id=stream_id, signer=receiver, environment={"now": Datetime(year=2023, month=1, day=1, hour=12)})
+        self.assertIn('No amount due on this stream.', str(context.exception))
+
+        # WHEN the stream is balanced a day after the cliff
+        self.currency.balance_stream(stream_id=stream_id, signer=receiver, environment={"now": Datetime(year=2023, month=1, day=3)})
+        # THEN only the time after the cliff should be paid
+        self.assertEqual(self.currency.balances[receiver], 86400)
+
+        # WHEN the stream is balanced and finalized after it closes
+        self.currency.balance_finalize(stream_id=stream_id, signer=receiver, environment={"now": closes})
+        # THEN the whole post-cliff period should be paid out
+        self.assertEqual(self.currency.balances[receiver], 2 * 86400)
+        self.assertEqual(self.currency.streams[stream_id, 'status'], 'finalized')
+
+    def test_create_schedule_stream_multiple_segments(self):
+        # GIVEN a stream that pays 2, then 1, then 3 per second for an hour each
+        sender = 'alice'
+        receiver = 'bob'
+        begins = Datetime(year=2023, month=1, day=1, hour=0)
+        closes = Datetime(year=2023, month=1, day=1, hour=3)
+        starts = [str(begins), str(Datetime(year=2023, month=1, day=1, hour=1)), str(Datetime(year=2023, month=1, day=1, hour=2))]
+        self.currency.balances[sender] = 1_000_000
+
+        stream_id = self.currency.create_schedule_stream(receiver=receiver, begins=str(begins), closes=str(closes), starts=starts, rates=[2, 1, 3], signer=sender)
+
+        # WHEN the stream is balanced halfway through the last segment
+        self.currency.balance_stream(stream_id=stream_id, signer=receiver, environment={"now": Datetime(year=2023, month=1, day=1, hour=2, minute=30)})
+        # THEN each segment should accrue at its own rate
+        self.assertEqual(self.currency.balances[receiver], 2 * 3600 + 3600 + 3 * 1800)
+
+    def test_create_schedule_stream_with_fractional_rates(self):
+        # GIVEN a stream that pays 0.1 per second for a second, then 0.2 per second
+        sender = 'alice'
+        receiver = 'bob'
+        begins = Datetime(year=2023, month=1, day=1, hour=0)
+        closes = Datetime(year=2023, month=1, day=1, hour=0, minute=0, second=3)
+        starts = [str(begins), str(Datetime(year=2023, month=1, day=1, hour=0, minute=0, second=1))]
+        self.currency.balances[sender] = 1_000_000
+
+        # WHEN it is created with rates passed inside a list, which the executor leaves as floats
+        stream_id = self.currency.create_schedule_stream(receiver=receiver, begins=str(begins), closes=str(closes), starts=starts, rates=[0.1, 0.2], signer=sender)
+
+        # THEN the schedule and the active rate are exact decimals
+        schedule = self.currency.streams[stream_id, 'schedule']
+        self.assertEqual(schedule[1][1], ContractingDecimal('0.2'))
+        self.assertEqual(schedule[1][2], ContractingDecimal('0.1'))
+        self.assertEqual(self.currency.get_stream_stats(signer=sender)['active_rate'], ContractingDecimal('0.2'))
+
+        # WHEN the stream is balanced and finalized after it closes
+        self.currency.balance_finalize(stream_id=stream_id, signer=receiver, environment={"now": closes})
+        # THEN exactly 0.1 + 2 * 0.2 is paid
+        self.assertEqual(self.currency.balances[receiver], ContractingDecimal('0.5'))
+        self.assertEqual(self.currency.balances[sender], ContractingDecimal('999999.5'))
+
+    def test_create_schedule_stream_invalid_schedule(self):
+        # GIVEN schedules that do not start at begins, are out of order or have no rate for a segment
+        sender = 'alice'
+        receiver = 'bob'
+        begins = Datetime(year=2023, month=1, day=1)
+        closes = Datetime(year=2023, month=1, day=4)
+        later = Datetime(year=2023, month=1, day=2)
+
+        # WHEN the streams are created
+        # THEN they should fail
+        with self.assertRaises(AssertionError):
+            self.currency.create_schedule_stream(receiver=receiver, begins=str(begins), closes=str(closes), starts=[str(later)], rates=[1], signer=sender)
+        with self.assertRaises(AssertionError):
+            self.currency.create_schedule_stream(receiver=receiver, begins=str(begins), closes=str(closes), starts=[str(begins), str(later), str(later)], rates=[1, 2, 3], signer=sender)
+        with self.assertRaises(AssertionError):
+            self.currency.create_schedule_stream(receiver=receiver, begins=str(begins), closes=str(closes), starts=[str(begins), str(later)], rates=[1], signer=sender)
+        with self.assertRaises(AssertionError):
+            self.currency.create_schedule_stream(receiver=receiver, begins=str(begins), closes=str(closes), starts=[str(begins), str(later)], rates=[1, 0], signer=sender)
+
+    def test_create_escrow_stream(self):
+        # GIVEN a sender with enough balance to fund a day-long stream
+        sender = 'alice'
+        receiver = 'bob'
+        begins = Datetime(year=2023, month=1, day=1)
+        closes = Datetime(year=2023, month=1, day=2)
+        self.currency.balances[sender] = 100_000
+
+        # WHEN an escrow stream is created
+        stream_id = self.currency.create_escrow_stream(receiver=receiver, rate=1, begins=str(begins), closes=str(closes), signer=sender)
+        # THEN the whole stream should be moved into its deposit
+        self.assertEqual(self.currency.streams[stream_id, 'deposit'], 86400)
+        self.assertEqual(self.currency.balances[sender], 100_000 - 86400)
+
+        # WHEN the sender spends the rest of their balance and the stream is balanced
+        self.currency.transfer(amount=100_000 - 86400, to='carol', signer=sender)
+        self.currency.balance_stream(stream_id=stream_id, signer=receiver, environment={"now": Datetime(year=2023, month=1, day=1, hour=12)})
+        # THEN the receiver should still be paid from the deposit
+        self.assertEqual(self.currency.balances[receiver], 43200)
+        self.assertEqual(self.currency.streams[stream_id, 'deposit'], 43200)
+
+        # WHEN the stream is balanced and finalized after it closes
+        self.currency.balance_finalize(stream_id=stream_id, signer=receiver, environment={"now": closes})
+        # THEN the deposit should be used up
+        self.assertEqual(self.currency.balances[receiver], 86400)
+        self.assertEqual(self.currency.streams[stream_id, 'deposit'], 0)
+        self.assertEqual(self.currency.streams[stream_id, 'status'], 'finalized')
+
+    def test_create_escrow_stream_fails_if_underfunded(self):
+        # GIVEN a sender who cannot fund the whole stream
+        self.currency.balances['alice'] = 100
+        # WHEN an escrow stream is created
+        # THEN it should fail
+        with self.assertRaises(AssertionError):
+            self.currency.create_escrow_stream(receiver='bob', rate=1, begins=str(Datetime(year=2023, month=1, day=1)), closes=str(Datetime(year=2023, month=1, day=2)), signer='alice')
+
+    def test_escrow_stream_change_close_time_refunds_and_tops_up(self):
+        # GIVEN an escrow stream with half of it claimed
+        sender = 'alice'
+        receiver = 'bob'
+        begins = Datetime(year=2023, month=1, day=1)
+        closes = Datetime(year=2023, month=1, day=2)
+        midday = Datetime(year=2023, month=1, day=1, hour=12)
+        self.currency.balances[sender] = 200_000
+        stream_id = self.currency.create_escrow_stream(receiver=receiver, rate=1, begins=str(begins), closes=str(closes), signer=sender)
+        self.currency.balance_stream(stream_id=stream_id, signer=receiver, environment={"now": midday})
+
+        # WHEN the sender closes the stream at 18:00
+        self.currency.change_close_time(stream_id=stream_id, new_close_time=str(Datetime(year=2023, month=1, day=1, hour=18)), signer=sender, environment={"now": midday})
+        # THEN the last six hours should be refunded
+        self.assertEqual(self.currency.streams[stream_id, 'deposit'], 21600)
+        self.assertEqual(self.currency.balances[sender], 200_000 - 86400 + 21600)
+
+        # WHEN the sender extends it to the next day
+        self.currency.change_close_time(stream_id=stream_id, new_close_time=str(Datetime(year=2023, month=1, day=3)), signer=sender, environment={"now": midday})
+        # THEN the deposit should be topped up
+        self.assertEqual(self.currency.streams[stream_id, 'deposit'], 86400 + 43200)
+        self.assertEqual(self.currency.balances[sender], 200_000 - 2 * 86400)
+
+    def test_escrow_stream_forfeit_refunds_deposit(self):
+        # GIVEN an escrow stream
+        self.currency.balances['alice'] = 100_000
+        stream_id = self.currency.create_escrow_stream(receiver='bob', rate=1, begins=str(Datetime(year=2023, month=1, day=1)), closes=str(Datetime(year=2023, month=1, day=2)), signer='alice')
+        # WHEN the receiver forfeits it
+        self.currency.forfeit_stream(stream_id=stream_id, signer='bob', environment={"now": Datetime(year=2023, month=1, day=1, hour=12)})
+        # THEN the deposit should go back to the sender
+        self.assertEqual(self.currency.balances['alice'], 100_000)
+        self.assertEqual(self.currency.streams[stream_id, 'deposit'], 0)
+
+    def test_stream_stats(self):
+        # GIVEN two day-long streams
+        sender = 'alice'
+        begins = Datetime(year=2023, month=1, day=1)
+        closes = Datetime(year=2023, month=1, day=2)
+        self.currency.balances[sender] = 1_000_000
+        first = self.currency.create_stream(receiver='bob', rate=1, begins=str(begins), closes=str(closes), signer=sender)
+        second = self.currency.create_stream(receiver='eve', rate=2, begins=str(begins), closes=str(closes), signer=sender)
+        # THEN both should be counted as active and fully committed
+        self.assertEqual(self.currency.get_stream_stats(signer=sender), {
+            'active_count': 2, 'active_rate': 3, 'total_streamed': 3 * 86400, 'total_claimed': 0
+        })
+
+        # WHEN the first is balanced and finalized and the second is forfeit halfway with nothing claimed
+        self.currency.balance_finalize(stream_id=first, signer='bob', environment={"now": closes})
+        self.currency.forfeit_stream(stream_id=second, signer='eve', environment={"now": Datetime(year=2023, month=1, day=1, hour=12)})
+        # THEN only the value paid out should remain
+        self.assertEqual(self.currency.get_stream_stats(signer=sender), {
+            'active_count': 0, 'active_rate': 0, 'total_streamed': 86400, 'total_claimed': 86400
+        })
+
     def test_sender_can_balance_stream(self):
         # GIVEN a stream setup where the sender can balance the stream
         sender = 'alice'
@@ -482,6 +762,63 @@ class TestCurrencyContract(unittest.TestCase):
         # THEN the close time should be set to the begin time
         assert self.currency.streams[stream_id, 'closes'] == begins
 
+    def test_finalize_expired(self):
+        # GIVEN three streams closing in the same hour, one of them underfunded
+        begins = Datetime(year=2023, month=1, day=1, hour=0)
+        closes = Datetime(year=2023, month=1, day=1, hour=10, minute=30)
+        self.currency.balances['alice'] = 1_000_000
+        self.currency.balances['carol'] = 100
+        first = self.currency.create_stream(receiver='bob', rate=1, begins=str(begins), closes=str(closes), signer='alice')
+        second = self.currency.create_stream(receiver='eve', rate=1, begins=str(begins), closes=str(closes), signer='alice')
+        underfunded = self.currency.create_stream(receiver='bob', rate=1, begins=str(begins), closes=str(closes), signer='carol')
+        self.assertEqual(self.close_bucket('2023-01-01 10'), [first, second, underfunded])
+
+        # WHEN the bucket is swept before the streams close
+        env = {"now": Datetime(year=2023, month=1, day=1, hour=10, minute=0)}
+        self.currency.finalize_expired(bucket='2023-01-01 10', max_count=10, signer='keeper', environment=env)
+        # THEN nothing is finalized and the streams are queued again in the same order
+        self.assertEqual(self.currency.streams[first, 'status'], 'active')
+        self.assertEqual(self.close_bucket('2023-01-01 10'), [first, second, underfunded])
+
+        # WHEN the bucket is swept after they close, two at a time
+        env = {"now": Datetime(year=2023, month=1, day=1, hour=11)}
+        result = self.currency.finalize_expired(bucket='2023-01-01 10', max_count=2, signer='keeper', environment=env)
+        # THEN the first two are settled and finalized
+        self.assertEqual(result, "Finalized 2 streams")
+        self.assertEqual(self.currency.streams[first, 'status'], 'finalized')
+        self.assertEqual(self.currency.streams[second, 'status'], 'finalized')
+        self.assertEqual(self.currency.balances['eve'], 10.5 * 3600)
+        self.assertEqual(self.close_bucket('2023-01-01 10'), [underfunded])
+
+        # WHEN the rest of the bucket is swept
+        result = self.currency.finalize_expired(bucket='2023-01-01 10', max_count=2, signer='keeper', environment=env)
+        # THEN the underfunded stream is settled as far as possible and kept
+        self.assertEqual(result, "Finalized 0 streams")
+        self.assertEqual(self.currency.streams[underfunded, 'status'], 'active')
+        self.assertEqual(self.currency.streams[underfunded, 'claimed'], 100)
+        self.assertEqual(self.close_bucket('2023-01-01 10'), [underfunded])
+
+    def test_change_close_time_moves_close_bucket(self):
+        # GIVEN a stream closing at 10:00
+        begins = Datetime(year=2023, month=1, day=1, hour=0)
+        closes = Datetime(year=2023, month=1, day=1, hour=10)
+        stream_id = self.currency.create_stream(receiver='bob', rate=1, begins=str(begins), closes=str(closes), signer='alice')
+
+        # WHEN its close time is moved to another hour
+        new_close_time = Datetime(year=2023, month=1, day=1, hour=12)
+        self.currency.change_close_time(stream_id=stream_id, new_close_time=str(new_close_time), signer='alice', environment={"now": begins})
+
+        # THEN it is queued under the new hour, and its old entry is left for the sweep to drop
+        self.assertEqual(self.close_bucket('2023-01-01 12'), [stream_id])
+        self.assertEqual(self.close_bucket('2023-01-01 10'), [stream_id])
+
+        # WHEN the old hour is swept
+        result = self.currency.finalize_expired(bucket='2023-01-01 10', max_count=10, signer='keeper', environment={"now": new_close_time})
+        # THEN the stale entry is dropped without touching the stream
+        self.assertEqual(result, "Finalized 0 streams")
+        self.assertEqual(self.close_bucket('2023-01-01 10'), [])
+        self.assertEqual(self.currency.streams[stream_id, 'status'], 'active')
+
     def test_create_stream_valid_permit(self):
         # GIVEN
         receiver = 'bob'
@@ -743,6 +1080,41 @@ class TestCurrencyContract(unittest.TestCase):
         self.assertEqual(self.currency.streams[stream_id, 'closes'], closes)
         self.assertEqual(self.currency.balances[receiver], (closes - begins).seconds * rate)
 
+    def test_close_balance_finalize_fails_if_not_sender(self):
+        # GIVEN a stream setup
+        sender = 'alice'
+        self.currency.balances[sender] = 100000000000000
+        receiver = 'bob'
+        rate = 10.0
+        begins = self.create_date(2023, 1, 1)
+        closes = self.create_date(2023, 12, 31)
+        stream_id = self.currency.create_stream(receiver=receiver, rate=rate, begins=str(begins), closes=str(closes), signer=sender)
+
+        # WHEN close_balance_finalize is called by the receiver
+        # THEN it should fail and leave the stream untouched
+        with self.assertRaises(AssertionError):
+            self.currency.close_balance_finalize(stream_id=stream_id, signer=receiver, environment={"now": self.create_date(2023, 6, 1)})
+        self.assertEqual(self.currency.streams[stream_id, 'status'], 'active')
+        self.assertEqual(self.currency.streams[stream_id, 'closes'], closes)
+        self.assertEqual(self.currency.streams[stream_id, 'claimed'], 0)
+
+    def test_balance_finalize_fails_if_underfunded(self):
+        # GIVEN a stream whose sender cannot cover the amount due
+        sender = 'alice'
+        receiver = 'bob'
+        rate = 1
+        begins = self.create_date(2023, 1, 1)
+        closes = self.create_date(2023, 1, 2)
+        self.currency.balances[sender] = 100
+        stream_id = self.currency.create_stream(receiver=receiver, rate=rate, begins=str(begins), closes=str(closes), signer=sender)
+
+        # WHEN balance_finalize is called
+        # THEN it should fail because the stream cannot be fully settled
+        with self.assertRaises(AssertionError) as context:
+            self.currency.balance_finalize(stream_id=stream_id, signer=receiver, environment={"now": closes})
+        self.assertIn('Stream has outstanding balance.', str(context.exception))
+        self.assertEqual(self.currency.streams[stream_id, 'status'], 'active')
+
     def test_balance_finalize(self):
         # GIVEN a stream setup
         sender = 'alice'
@@ -761,5 +1133,202 @@ class TestCurrencyContract(unittest.TestCase):
         self.assertEqual(stream_status, 'finalized')
         self.assertEqual(self.currency.balances[receiver], (closes - begins).seconds * rate)
 
+    def test_transfer_settles_incoming_streams_when_opted_in(self):
+        # GIVEN a receiver with no balance, auto settle enabled and an accrued incoming stream
+        sender = 'alice'
+        receiver = 'bob'
+        begins = self.create_date(2023, 1, 1)
+        closes = self.create_date(2023, 1, 2)
+        self.currency.balances[sender] = 1000
+        stream_id = self.currency.create_stream(receiver=receiver, rate=1, begins=str(begins), closes=str(closes), signer=sender)
+        self.currency.set_auto_settle(enabled=True, signer=receiver)
+
+        # WHEN the receiver transfers part of what the stream has accrued
+        self.currency.transfer(amount=50, to='carol', signer=receiver, environment={"now": Datetime(year=2023, month=1, day=1, hour=0, minute=1)})
+
+        # THEN the stream is settled first and the transfer goes through
+        self.assertEqual(self.currency.streams[stream_id, 'claimed'], 60)
+        self.assertEqual(self.currency.balances[receiver], 10)
+        self.assertEqual(self.currency.balances['carol'], 50)
+        self.assertEqual(self.currency.balances[sender], 940)
+
+    def test_settle_on_spend_walks_incoming_queue_from_head(self):
+        # GIVEN an opted-in receiver with a forfeited stream ahead of an accrued one in its queue
+        begins = self.create_date(2023, 1, 1)
+        closes = self.create_date(2023, 1, 2)
+        self.currency.balances['alice'] = 1000
+        self.currency.balances['carol'] = 1000
+        forfeited = self.currency.create_stream(receiver='bob', rate=1, begins=str(begins), closes=str(closes), signer='alice')
+        accrued = self.currency.create_stream(receiver='bob', rate=1, begins=str(begins), closes=str(closes), signer='carol')
+        self.currency.forfeit_stream(stream_id=forfeited, signer='bob', environment={"now": begins})
+        self.currency.set_auto_settle(enabled=True, signer='bob')
+
+        # WHEN the receiver spends
+        self.currency.transfer(amount=50, to='dave', signer='bob', environment={"now": Datetime(year=2023, month=1, day=1, hour=0, minute=1)})
+
+        # THEN the forfeited stream is dropped and the settled stream is queued again at the tail
+        self.assertEqual(self.currency.streams[accrued, 'claimed'], 60)
+        self.assertEqual(self.currency.incoming_stream_heads['bob'], 2)
+        self.assertEqual(self.currency.incoming_stream_tails['bob'], 3)
+        self.assertEqual(self.currency.incoming_streams['bob', 2], accrued)
+
+    def test_settle_on_spend_leaves_unsettled_streams_in_place(self):
+        # GIVEN an opted-in receiver whose first incoming stream has not begun yet
+        begins = self.create_date(2023, 1, 1)
+        closes = self.create_date(2023, 1, 2)
+        self.currency.balances['alice'] = 1000
+        self.currency.balances['carol'] = 1000
+        pending = self.currency.create_stream(receiver='bob', rate=1, begins=str(closes), closes=str(self.create_date(2023, 1, 3)), signer='alice')
+        accrued = self.currency.create_stream(receiver='bob', rate=1, begins=str(begins), closes=str(closes), signer='carol')
+        self.currency.set_auto_settle(enabled=True, signer='bob')
+
+        # WHEN the receiver spends
+        self.currency.transfer(amount=50, to='dave', signer='bob', environment={"now": Datetime(year=2023, month=1, day=1, hour=0, minute=1)})
+
+        # THEN only the settled stream moves to the tail; the pending one takes the freed slot
+        self.assertEqual(self.currency.streams[accrued, 'claimed'], 60)
+        self.assertEqual(self.currency.incoming_stream_heads['bob'], 1)
+        self.assertEqual(self.currency.incoming_stream_tails['bob'], 3)
+        self.assertEqual(self.currency.incoming_streams['bob', 1], pending)
+        self.assertEqual(self.currency.incoming_streams['bob', 2], accrued)
+
+    def test_transfer_does_not_settle_incoming_streams_by_default(self):
+        # GIVEN a receiver with no balance and an accrued incoming stream, without auto settle
+        sender = 'alice'
+        receiver = 'bob'
+        begins = self.create_date(2023, 1, 1)
+        closes = self.create_date(2023, 1, 2)
+        self.currency.balances[sender] = 1000
+        stream_id = self.currency.create_stream(receiver=receiver, rate=1, begins=str(begins), closes=str(closes), signer=sender)
+
+        # WHEN the receiver tries to transfer
+        # THEN it fails and the stream is left untouched
+        with self.assertRaises(AssertionError):
+            self.currency.transfer(amount=50, to='carol', signer=receiver, environment={"now": Datetime(year=2023, month=1, day=1, hour=0, minute=1)})
+        self.assertEqual(self.currency.streams[stream_id, 'claimed'], 0)
+
+    def test_merge_streams_with_same_window(self):
+        # GIVEN two partly settled streams with the same window from one sender to one receiver
+        sender = 'alice'
+        receiver = 'bob'
+        begins = self.create_date(2023, 1, 1)
+        closes = self.create_date(2023, 1, 2)
+        self.currency.balances[sender] = 1_000_000
+        first = self.currency.create_stream(receiver=receiver, rate=1, begins=str(begins), closes=str(closes), signer=sender)
+        second = self.currency.create_stream(receiver=receiver, rate=2, begins=str(begins), closes=str(closes), signer=sender)
+        self.currency.balance_stream(stream_id=first, signer=receiver, environment={"now": Datetime(year=2023, month=1, day=1, hour=1)})
+
+        # WHEN the receiver merges them
+        merged = self.currency.merge_streams(stream_ids=[first, second], signer=receiver, environment={"now": Datetime(year=2023, month=1, day=1, hour=2)})
+
+        # THEN both are settled and folded into one plain stream with the combined rate and claimed amount
+        self.assertEqual(self.currency.streams[merged, 'rate'], 3)
+        self.assertIsNone(self.currency.streams[merged, 'schedule'])
+        self.assertEqual(self.currency.streams[merged, 'claimed'], 3 * 7200)
+        self.assertEqual(self.currency.balances[receiver], 3 * 7200)
+        for stream_id in [first, second]:
+            self.assertEqual(self.currency.streams[stream_id, 'status'], 'merged')
+            self.assertEqual(self.currency.streams[stream_id, 'merged_into'], merged)
+
+        stats = self.currency.get_stream_stats(signer=sender)
+        self.assertEqual(stats['active_count'], 1)
+        self.assertEqual(stats['active_rate'], 3)
+
+        # AND the merged stream pays out the rest of both streams
+        self.currency.balance_finalize(stream_id=merged, signer=receiver, environment={"now": closes})
+        self.assertEqual(self.currency.balances[receiver], 3 * 86400)
+
+    def test_merge_streams_with_different_windows(self):
+        # GIVEN two streams whose windows overlap
+        sender = 'alice'
+        receiver = 'bob'
+        self.currency.balances[sender] = 1_000_000
+        first = self.currency.create_stream(receiver=receiver, rate=1, begins='2023-01-01 00:00:00', closes='2023-01-01 02:00:00', signer=sender)
+        second = self.currency.create_stream(receiver=receiver, rate=2, begins='2023-01-01 01:00:00', closes='2023-01-01 03:00:00', signer=sender)
+
+        # WHEN the sender merges them before either begins
+        merged = self.currency.merge_streams(stream_ids=[first, second], signer=sender, environment={"now": self.create_date(2022, 12, 31)})
+
+        # THEN the merged stream follows a schedule that adds up both streams
+        self.assertEqual(self.currency.streams[merged, 'schedule'], [[0, 1, 0], [3600, 3, 3600], [7200, 2, 14400]])
+        self.assertEqual(self.currency.streams[merged, 'rate'], 2)
+        self.assertEqual(str(self.currency.streams[merged, 'closes']), '2023-01-01 03:00:00')
+
+    def test_merge_streams_fails_for_different_receivers(self):
+        # GIVEN two streams from one sender to different receivers
+        sender = 'alice'
+        self.currency.balances[sender] = 1_000_000
+        first = self.currency.create_stream(receiver='bob', rate=1, begins='2023-01-01 00:00:00', closes='2023-01-02 00:00:00', signer=sender)
+        second = self.currency.create_stream(receiver='carol', rate=1, begins='2023-01-01 00:00:00', closes='2023-01-02 00:00:00', signer=sender)
+
+        # WHEN the sender tries to merge them
+        # THEN it fails and both streams stay active
+        with self.assertRaises(AssertionError) as context:
+            self.currency.merge_streams(stream_ids=[first, second], signer=sender)
+        self.assertIn('Streams must have the same sender and receiver.', str(context.exception))
+        self.assertEqual(self.currency.streams[first, 'status'], 'active')
+        self.assertEqual(self.currency.streams[second, 'status'], 'active')
+
+    def test_subscription_charges_each_period(self):
+        # GIVEN a daily subscription of 100 with no maximum number of periods
+        sender = 'alice'
+        receiver = 'bob'
+        self.currency.balances[sender] = 1000
+        stream_id = self.currency.create_subscription_stream(receiver=receiver, amount=100, period=86400, begins='2023-01-01 00:00:00', signer=sender)
+        self.assertIsNone(self.currency.streams[stream_id, 'closes'])
+
+        # WHEN the receiver balances it during the third day
+        self.currency.balance_stream(stream_id=stream_id, signer=receiver, environment={"now": Datetime(year=2023, month=1, day=3, hour=12)})
+
+        # THEN every period that has started is paid, with no transaction per period
+        self.assertEqual(self.currency.balances[receiver], 300)
+        self.assertEqual(self.currency.streams[stream_id, 'claimed'], 300)
+
+        stats = self.currency.get_stream_stats(signer=sender)
+        self.assertEqual(stats['total_streamed'], 300)
+        self.assertEqual(stats['active_rate'], 0)
+
+    def test_subscription_with_max_periods(self):
+        # GIVEN an hourly subscription limited to three periods
+        sender = 'alice'
+        receiver = 'bob'
+        self.currency.balances[sender] = 1000
+        stream_id = self.currency.create_subscription_stream(receiver=receiver, amount=10, period=3600, begins='2023-01-01 00:00:00', max_periods=3, signer=sender)
+
+        # WHEN it is balanced and finalized long after the last period
+        self.currency.balance_finalize(stream_id=stream_id, signer=receiver, environment={"now": self.create_date(2023, 1, 2)})
+
+        # THEN only three periods were charged
+        self.assertEqual(str(self.currency.streams[stream_id, 'closes']), '2023-01-01 03:00:00')
+        self.assertEqual(self.currency.balances[receiver], 30)
+        self.assertEqual(self.currency.streams[stream_id, 'status'], 'finalized')
+
+    def test_cancel_subscription_ends_current_period(self):
+        # GIVEN a daily subscription that has run into its second day
+        sender = 'alice'
+        receiver = 'bob'
+        self.currency.balances[sender] = 1000
+        stream_id = self.currency.create_subscription_stream(receiver=receiver, amount=100, period=86400, begins='2023-01-01 00:00:00', signer=sender)
+
+        # WHEN the sender cancels it
+        self.currency.cancel_subscription(stream_id=stream_id, signer=sender, environment={"now": Datetime(year=2023, month=1, day=2, hour=6)})
+
+        # THEN it ends with the running period, which stays charged
+        self.assertEqual(str(self.currency.streams[stream_id, 'closes']), '2023-01-03 00:00:00')
+        self.currency.balance_finalize(stream_id=stream_id, signer=receiver, environment={"now": self.create_date(2023, 1, 10)})
+        self.assertEqual(self.currency.balances[receiver], 200)
+
+    def test_cancel_subscription_fails_for_regular_stream(self):
+        # GIVEN a regular stream
+        sender = 'alice'
+        self.currency.balances[sender] = 1000
+        stream_id = self.currency.create_stream(receiver='bob', rate=1, begins='2023-01-01 00:00:00', closes='2023-01-02 00:00:00', signer=sender)
+
+        # WHEN it is cancelled as a subscription
+        # THEN it fails
+        with self.assertRaises(AssertionError) as context:
+            self.currency.cancel_subscription(stream_id=stream_id, signer=sender)
+        self.assertIn('Stream is not a subscription.', str(context.exception))
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,105 @@
+import os
+import sys
+import tempfile
+import unittest
+from profiler import ContractProfiler
+
+# Stands in for a loaded contract: contracting runs contract code in a module
+# named after the contract, with private functions stored under "__"
+CONTRACT_CODE = '''
+def __calc_outstanding_balance(rate, seconds, claimed):
+    return rate * seconds - claimed
+
+def balance_stream(rate, seconds):
+    return __calc_outstanding_balance(rate, seconds, len([1, 2]))
+'''
+
+
+class FakeClock:
+    def __init__(self):
+        self.ticks = 0
+
+    def __call__(self):
+        self.ticks += 1000
+        return self.ticks
+
+
+def load_contract(name):
+    namespace = {"__name__": name}
+    exec(CONTRACT_CODE, namespace)
+    return namespace
+
+
+def helper():
+    return 1
+
+
+class TestContractProfiler(unittest.TestCase):
+    def setUp(self):
+        self.contract = load_contract("currency")
+
+    def test_records_exports_and_internal_functions(self):
+        # GIVEN a profiler for the contract
+        profiler = ContractProfiler(["currency"], clock=FakeClock())
+
+        # WHEN an export is called while profiling
+        with profiler:
+            self.assertEqual(self.contract["balance_stream"](3, 10), 28)
+
+        # THEN the export and the internal function it calls have their own stacks,
+        # with the private prefix stripped
+        stacks = [stack for stack in profiler.samples]
+        self.assertIn(("balance_stream",), stacks)
+        self.assertIn(("balance_stream", "calc_outstanding_balance"), stacks)
+        self.assertIn(("balance_stream", "len"), stacks)
+
+        times = {name: (own, total) for name, own, total in profiler.function_times()}
+        self.assertGreaterEqual(times["balance_stream"][1], times["calc_outstanding_balance"][1])
+
+    def test_ignores_other_modules(self):
+        # GIVEN a profiler for a different contract
+        profiler = ContractProfiler(["stream_engine"], clock=FakeClock())
+
+        # WHEN code outside the profiled contracts runs
+        with profiler:
+            self.contract["balance_stream"](3, 10)
+            helper()
+
+        # THEN nothing is recorded
+        self.assertEqual(dict(profiler.samples), {})
+
+    def test_write_collapsed(self):
+        # GIVEN a profile of one export call
+        profiler = ContractProfiler(["currency"], clock=FakeClock())
+        with profiler:
+            self.contract["balance_stream"](3, 10)
+
+        # WHEN the collapsed stacks are written
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "currency.collapsed")
+            profiler.write_collapsed(path)
+            with open(path) as f:
+                lines = f.read().splitlines()
+
+        # THEN every line is a ";"-joined stack followed by a positive count
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            self.assertTrue(stack.startswith("balance_stream"))
+            self.assertGreater(int(count), 0)
+
+    def test_stop_restores_previous_profile(self):
+        # GIVEN no profile function installed
+        self.assertIsNone(sys.getprofile())
+
+        # WHEN a profiler starts and stops
+        profiler = ContractProfiler(["currency"], clock=FakeClock())
+        profiler.start()
+        profiler.stop()
+
+        # THEN the previous (empty) profile function is restored
+        self.assertIsNone(sys.getprofile())
+
+
+if __name__ == "__main__":
+    unittest.main()
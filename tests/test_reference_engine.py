@@ -0,0 +1,205 @@
+import datetime
+import random
+import unittest
+from contracting.stdlib.bridge.time import Datetime
+from contracting.client import ContractingClient
+from xian_py.wallet import Wallet
+from reference_engine import ReferenceEngine
+
+# Permits need a real key pair; the wallet's address takes part like any other account
+WALLET = Wallet('ed30796abc4ab47a97bfb37359f50a9c362c7b304a4b4ad1b3f5369ecb6f7fd8')
+ACCOUNTS = ["sys", "alice", "bob", "carol", "dave", WALLET.public_key]
+STREAM_FIELDS = ("status", "sender", "receiver", "rate", "claimed", "schedule", "deposit", "merged_into", "period")
+
+
+def to_contract_time(d):
+    return Datetime(d.year, d.month, d.day, hour=d.hour, minute=d.minute, second=d.second)
+
+
+def fmt(d):
+    return d.strftime('%Y-%m-%d %H:%M:%S')
+
+
+# Whole or fractional amounts up to `high`. Fractions have at most two decimals and
+# never end in .0, so they format the same in a signed message and in the contract
+def random_amount(rng, high):
+    if rng.random() < 0.5:
+        return rng.randint(1, high)
+
+    cents = rng.randint(1, high * 100)
+    if cents % 100 == 0:
+        cents += 1
+    return cents / 100
+
+
+class TestReferenceEngine(unittest.TestCase):
+    # Replays random operation sequences through the contract and the reference
+    # engine, asserting both accept or reject each call and end in the same state
+    def setUp(self):
+        self.chain_id = "test-chain"
+        self.client = ContractingClient(environment={"chain_id": self.chain_id})
+        self.client.flush()
+
+        with open("token_xsc003.py") as f:
+            self.client.submit(f.read(), name="currency")
+
+        self.currency = self.client.get_contract("currency")
+        self.reference = ReferenceEngine(operator="sys", contract="currency", chain_id=self.chain_id)
+        self.now = datetime.datetime(2023, 1, 1)
+        self.stream_ids = []
+
+    def tearDown(self):
+        self.client.flush()
+
+    def call(self, function, signer, **kwargs):
+        contract_result = contract_error = None
+        reference_result = reference_error = None
+
+        try:
+            contract_result = getattr(self.currency, function)(
+                signer=signer, environment={"now": to_contract_time(self.now), "chain_id": self.chain_id}, **kwargs
+            )
+        except AssertionError as e:
+            contract_error = e
+
+        self.reference.now = self.now
+        try:
+            reference_result = getattr(self.reference, function)(signer=signer, **kwargs)
+        except AssertionError as e:
+            reference_error = e
+
+        self.assertEqual(
+            contract_error is None, reference_error is None,
+            f"{function}({kwargs}) at {self.now}: contract raised {contract_error!r}, reference raised {reference_error!r}"
+        )
+
+        if contract_error is None and (function.startswith("create") or function == "merge_streams"):
+            self.assertEqual(contract_result, reference_result)
+            self.stream_ids.append(reference_result)
+
+    def assert_same_state(self):
+        for address in ACCOUNTS:
+            self.assertEqual(self.currency.balances[address], self.reference.balances.get(address, 0), address)
+            for spender in ACCOUNTS:
+                self.assertEqual(self.currency.allowances[address, spender], self.reference.allowances.get((address, spender), 0))
+
+        self.assertEqual(self.currency.get_holder_count(signer="sys"), self.reference.holder_count)
+        self.assertEqual(self.currency.get_total_supply(signer="sys"), self.reference.total_supply)
+        self.assertEqual(self.currency.get_stream_stats(signer="sys"), self.reference.stream_stats)
+
+        for stream_id, stream in self.reference.streams.items():
+            for field in STREAM_FIELDS:
+                self.assertEqual(self.currency.streams[stream_id, field], getattr(stream, field), f"{stream_id} {field}")
+            self.assertEqual(str(self.currency.streams[stream_id, "begins"]), str(stream.begins))
+            self.assertEqual(str(self.currency.streams[stream_id, "closes"]), str(stream.closes))
+
+        for bucket, tail in self.reference.close_bucket_tails.items():
+            self.assertEqual(self.currency.close_bucket_heads[bucket], self.reference.close_bucket_heads.get(bucket, 0), bucket)
+            self.assertEqual(self.currency.close_bucket_tails[bucket], tail, bucket)
+            for i in range(tail):
+                self.assertEqual(self.currency.close_buckets[bucket, i], self.reference.close_buckets.get((bucket, i)), (bucket, i))
+
+        for address, tail in self.reference.incoming_stream_tails.items():
+            self.assertEqual(self.currency.incoming_stream_heads[address], self.reference.incoming_stream_heads.get(address, 0), address)
+            self.assertEqual(self.currency.incoming_stream_tails[address], tail, address)
+            for i in range(tail):
+                self.assertEqual(self.currency.incoming_streams[address, i], self.reference.incoming_streams.get((address, i)), (address, i))
+
+    def random_time(self, rng, low_hours, high_hours):
+        return self.now + datetime.timedelta(hours=rng.randint(low_hours, high_hours))
+
+    def random_operation(self, rng):
+        sender = rng.choice(ACCOUNTS)
+        receiver = rng.choice(ACCOUNTS)
+        kind = rng.randrange(18)
+
+        # Batch amounts and schedule rates are fractional too: floats nested in lists
+        # skip the executor's conversion, and the contract converts them itself
+        if kind == 0:
+            self.call("transfer", sender, amount=random_amount(rng, 50_000), to=receiver)
+        elif kind == 1:
+            self.call("approve", sender, amount=random_amount(rng, 50_000), to=receiver)
+        elif kind == 2:
+            self.call("transfer_from", receiver, amount=random_amount(rng, 50_000), to=rng.choice(ACCOUNTS), main_account=sender)
+        elif kind == 3:
+            recipients = rng.sample(ACCOUNTS, rng.randint(1, 3))
+            if rng.random() < 0.5:
+                self.call("transfer_many", sender, recipients=recipients, amounts=[random_amount(rng, 20_000) for _ in recipients])
+            else:
+                self.call("transfer_from_many", receiver, recipients=recipients, amounts=[random_amount(rng, 20_000) for _ in recipients], main_account=sender)
+        elif kind in (4, 5):
+            begins = self.random_time(rng, -12, 12)
+            closes = begins + datetime.timedelta(hours=rng.randint(0, 24))
+            function = "create_stream" if kind == 4 else "create_escrow_stream"
+            self.call(function, sender, receiver=receiver, rate=random_amount(rng, 3), begins=fmt(begins), closes=fmt(closes))
+        elif kind == 16:
+            value = random_amount(rng, 50_000)
+            deadline = fmt(self.random_time(rng, -2, 24))
+            msg = f"{WALLET.public_key}:{receiver}:{value}:{deadline}:currency:{self.chain_id}"
+            # Now and then sign something else, so the signature check is exercised
+            signature = WALLET.sign_msg(msg if rng.random() < 0.9 else msg + "x")
+            self.call("permit", sender, owner=WALLET.public_key, spender=receiver, value=value, deadline=deadline, signature=signature)
+        elif kind == 17:
+            rate = random_amount(rng, 3)
+            begins = fmt(self.random_time(rng, -12, 12))
+            closes = fmt(self.random_time(rng, 13, 36))
+            deadline = fmt(self.random_time(rng, -2, 24))
+            msg = f"{WALLET.public_key}:{receiver}:{rate}:{begins}:{closes}:{deadline}:currency:{self.chain_id}"
+            self.call("create_stream_from_permit", sender, sender=WALLET.public_key, receiver=receiver, rate=rate,
+                      begins=begins, closes=closes, deadline=deadline, signature=WALLET.sign_msg(msg))
+        elif kind == 12:
+            self.call("set_auto_settle", sender, enabled=rng.random() < 0.7)
+        elif kind == 14:
+            max_periods = rng.choice([None, 1, 3, 12])
+            self.call("create_subscription_stream", sender, receiver=receiver, amount=random_amount(rng, 5_000),
+                      period=rng.choice([600, 3600, 86400]), begins=fmt(self.random_time(rng, -12, 12)), max_periods=max_periods)
+        elif kind == 6:
+            begins = self.random_time(rng, -12, 12)
+            cliff = begins + datetime.timedelta(hours=rng.randint(1, 6))
+            closes = cliff + datetime.timedelta(hours=rng.randint(1, 12))
+            self.call("create_schedule_stream", sender, receiver=receiver, begins=fmt(begins), closes=fmt(closes),
+                      starts=[fmt(begins), fmt(cliff)], rates=[rng.choice([0, random_amount(rng, 2)]), random_amount(rng, 3)])
+        elif self.stream_ids:
+            stream_id = rng.choice(self.stream_ids)
+            stream = self.reference.streams[stream_id]
+            party = rng.choice([stream.sender, stream.receiver, sender])
+
+            if kind == 7:
+                self.call("balance_stream", party, stream_id=stream_id)
+            elif kind == 8:
+                self.call("change_close_time", party, stream_id=stream_id, new_close_time=fmt(self.random_time(rng, -6, 24)))
+            elif kind == 9:
+                function = rng.choice(["finalize_stream", "balance_finalize", "close_balance_finalize"])
+                self.call(function, party, stream_id=stream_id)
+            elif kind == 10:
+                self.call("forfeit_stream", party, stream_id=stream_id)
+            elif kind == 15:
+                self.call("cancel_subscription", party, stream_id=stream_id)
+            elif kind == 13:
+                # Mostly streams with the same parties, so that most merges are valid
+                siblings = [i for i in self.stream_ids if rng.random() < 0.1 or (
+                    self.reference.streams[i].sender == stream.sender and self.reference.streams[i].receiver == stream.receiver)]
+                merged = rng.sample(siblings, min(len(siblings), rng.randint(1, 4)))
+                self.call("merge_streams", party, stream_ids=merged)
+            else:
+                self.call("finalize_expired", sender, bucket=str(stream.closes)[:13], max_count=rng.randint(1, 3))
+
+        self.now += datetime.timedelta(minutes=rng.randint(0, 240))
+
+    def test_random_sequences_match_contract(self):
+        for seed in range(3):
+            with self.subTest(seed=seed):
+                self.setUp()
+                rng = random.Random(seed)
+
+                for address in ACCOUNTS[1:]:
+                    self.call("transfer", "sys", amount=150_000, to=address)
+
+                for _ in range(150):
+                    self.random_operation(rng)
+
+                self.assert_same_state()
+
+
+if __name__ == "__main__":
+    unittest.main()
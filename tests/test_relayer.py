@@ -0,0 +1,114 @@
+import asyncio
+import datetime
+import unittest
+from xian_py.wallet import Wallet
+from relayer import StreamRelayer, StreamPermit, construct_stream_permit_msg, RELAY_SUBMITTED, RELAY_EXPIRED, RELAY_FAILED
+
+
+class StandInNode:
+    # Local stand-in for a node: records what it receives and how many
+    # submissions were in flight at once
+    def __init__(self, contract, chain_id, fail_receivers=()):
+        self.contract = contract
+        self.chain_id = chain_id
+        self.fail_receivers = fail_receivers
+        self.received = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def submit(self, contract, function, kwargs):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+
+        assert function == "create_stream_from_permit"
+        if kwargs["receiver"] in self.fail_receivers:
+            raise Exception('Permit can only be used once.')
+
+        assert kwargs["signature"], 'Invalid signature.'
+        self.received.append(kwargs)
+        return {"success": True}
+
+
+class TestStreamRelayer(unittest.TestCase):
+    def setUp(self):
+        self.private_key = 'ed30796abc4ab47a97bfb37359f50a9c362c7b304a4b4ad1b3f5369ecb6f7fd8'
+        self.wallet = Wallet(self.private_key)
+        self.chain_id = "test-chain"
+        self.now = datetime.datetime(2023, 1, 3)
+
+    def make_permit(self, receiver, deadline):
+        return StreamPermit(
+            sender=self.wallet.public_key,
+            receiver=receiver,
+            rate=1,
+            begins="2023-01-01 00:00:00",
+            closes="2023-01-10 00:00:00",
+            deadline=deadline,
+        )
+
+    def run_relayer(self, node, permits, **kwargs):
+        async def run():
+            async with StreamRelayer(node, self.private_key, "currency", self.chain_id, clock=lambda: self.now, workers=1, **kwargs) as relayer:
+                return await relayer.relay(permits)
+        return asyncio.run(run())
+
+    def test_relay_signs_and_submits_permits(self):
+        # GIVEN a batch of valid permits
+        node = StandInNode("currency", self.chain_id)
+        permits = [self.make_permit(f"receiver_{i}", "2023-01-11 00:00:00") for i in range(5)]
+
+        # WHEN they are relayed
+        results = self.run_relayer(node, permits, batch_size=2)
+
+        # THEN every permit is signed by the sender and submitted
+        self.assertEqual([r.status for r in results], [RELAY_SUBMITTED] * 5)
+        self.assertEqual(len(node.received), 5)
+        for permit in permits:
+            msg = construct_stream_permit_msg(permit.sender, permit.receiver, permit.rate, permit.begins, permit.closes, permit.deadline, "currency", self.chain_id)
+            self.assertEqual(permit.signature, self.wallet.sign_msg(msg))
+
+    def test_relay_drops_expired_permits(self):
+        # GIVEN one expired and one live permit
+        node = StandInNode("currency", self.chain_id)
+        expired = self.make_permit("late", "2023-01-02 00:00:00")
+        live = self.make_permit("on_time", "2023-01-11 00:00:00")
+
+        # WHEN they are relayed
+        results = self.run_relayer(node, [expired, live])
+
+        # THEN only the live permit reaches the node
+        statuses = {r.permit.receiver: r.status for r in results}
+        self.assertEqual(statuses, {"late": RELAY_EXPIRED, "on_time": RELAY_SUBMITTED})
+        self.assertEqual([k["receiver"] for k in node.received], ["on_time"])
+        self.assertIsNone(expired.signature)
+
+    def test_relay_bounds_concurrency(self):
+        # GIVEN more permits than allowed in flight
+        node = StandInNode("currency", self.chain_id)
+        permits = [self.make_permit(f"receiver_{i}", "2023-01-11 00:00:00") for i in range(10)]
+
+        # WHEN they are relayed with a limit of 3
+        self.run_relayer(node, permits, max_in_flight=3)
+
+        # THEN the node never sees more than 3 submissions at once
+        self.assertLessEqual(node.max_in_flight, 3)
+        self.assertEqual(len(node.received), 10)
+
+    def test_relay_reports_failed_submissions(self):
+        # GIVEN a node that rejects one permit
+        node = StandInNode("currency", self.chain_id, fail_receivers=("bad",))
+        permits = [self.make_permit("bad", "2023-01-11 00:00:00"), self.make_permit("good", "2023-01-11 00:00:00")]
+
+        # WHEN they are relayed
+        results = self.run_relayer(node, permits)
+
+        # THEN the failure is reported without stopping the other submission
+        statuses = {r.permit.receiver: r.status for r in results}
+        self.assertEqual(statuses, {"bad": RELAY_FAILED, "good": RELAY_SUBMITTED})
+        self.assertIn('Permit can only be used once', str([r for r in results if r.status == RELAY_FAILED][0].result))
+
+
+if __name__ == "__main__":
+    unittest.main()
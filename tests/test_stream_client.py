@@ -0,0 +1,160 @@
+import datetime
+import unittest
+from stream_client import StreamCache, utcnow
+
+
+class FakeNode:
+    def __init__(self):
+        self.state = {}
+        self.reads = 0
+
+    def set(self, key, value):
+        self.state[key] = value
+
+    def get_state(self, contract, variable, *keys):
+        self.reads += 1
+        return self.state.get(":".join([f"{contract}.{variable}"] + list(keys)))
+
+
+class TestStreamCache(unittest.TestCase):
+    def setUp(self):
+        self.node = FakeNode()
+        self.cache = StreamCache(self.node.get_state, contract="currency", max_entries=100)
+        self.add_stream("s1", "alice", "bob", rate=1, begins="2023-01-01 00:00:00", closes="2023-01-02 00:00:00")
+        self.node.set("currency.balances:alice", 1_000_000)
+
+    def add_stream(self, stream_id, sender, receiver, rate, begins, closes, claimed=0, schedule=None, deposit=None):
+        fields = {
+            "status": "active", "sender": sender, "receiver": receiver, "rate": rate,
+            "begins": begins, "closes": closes, "claimed": claimed, "schedule": schedule, "deposit": deposit,
+        }
+        for field, value in fields.items():
+            self.node.set(f"currency.streams:{stream_id}:{field}", value)
+
+    def test_outstanding_is_computed_locally(self):
+        # GIVEN a stream read once through the cache
+        at = datetime.datetime(2023, 1, 1, 1)
+        self.assertEqual(self.cache.outstanding("s1", at), 3600)
+        reads = self.node.reads
+
+        # WHEN the outstanding amount is read again later
+        later = self.cache.outstanding("s1", datetime.datetime(2023, 1, 1, 2))
+
+        # THEN it is recomputed without hitting the node
+        self.assertEqual(later, 7200)
+        self.assertEqual(self.node.reads, reads)
+
+    def test_apply_block_invalidates_changed_keys(self):
+        # GIVEN a cached stream
+        at = datetime.datetime(2023, 1, 1, 1)
+        self.cache.outstanding("s1", at)
+
+        # WHEN a block settles part of it
+        self.node.set("currency.streams:s1:claimed", 1800)
+        self.node.set("currency.balances:alice", 1_000_000 - 1800)
+        self.cache.apply_block(10, ["currency.streams:s1:claimed", "currency.balances:alice"])
+
+        # THEN only the changed keys are re-read
+        reads = self.node.reads
+        self.assertEqual(self.cache.outstanding("s1", at), 1800)
+        self.assertEqual(self.node.reads, reads + 2)
+
+        # WHEN an old block is replayed
+        self.node.set("currency.streams:s1:claimed", 0)
+        self.cache.apply_block(9, ["currency.streams:s1:claimed"])
+        # THEN it is ignored
+        self.assertEqual(self.cache.outstanding("s1", at), 1800)
+
+    def test_apply_block_clears_cache_after_skipped_blocks(self):
+        # GIVEN a cached stream and a block applied at height 10
+        at = datetime.datetime(2023, 1, 1, 1)
+        self.cache.apply_block(10, [])
+        self.cache.outstanding("s1", at)
+
+        # WHEN block 11 is missed and block 12 is applied
+        self.node.set("currency.streams:s1:claimed", 1800)
+        self.cache.apply_block(12, [])
+
+        # THEN nothing stale is served
+        self.assertEqual(len(self.cache.entries), 0)
+        self.assertEqual(self.cache.outstanding("s1", at), 1800)
+        self.assertEqual(self.cache.height, 12)
+
+    def test_outstanding_is_capped_by_sender_balance(self):
+        # GIVEN a sender that cannot cover the stream
+        self.node.set("currency.balances:alice", 500)
+
+        # WHEN the outstanding amount is read after the stream closes
+        # THEN it is capped at the sender's balance
+        self.assertEqual(self.cache.outstanding("s1", datetime.datetime(2023, 1, 3)), 500)
+
+    def test_outstanding_for_escrow_stream_is_capped_by_deposit(self):
+        # GIVEN an escrow stream whose sender has spent their whole balance
+        self.add_stream("s4", "carol", "bob", rate=1, begins="2023-01-01 00:00:00", closes="2023-01-02 00:00:00", deposit=86400)
+        self.node.set("currency.balances:carol", 0)
+
+        # WHEN the outstanding amount is read half way through
+        # THEN it is paid from the deposit
+        self.assertEqual(self.cache.outstanding("s4", datetime.datetime(2023, 1, 1, 12)), 43200)
+
+        # WHEN the deposit no longer covers what is due
+        self.node.set("currency.streams:s4:deposit", 1000)
+        self.cache.apply_block(1, ["currency.streams:s4:deposit"])
+
+        # THEN it is capped at the deposit
+        self.assertEqual(self.cache.outstanding("s4", datetime.datetime(2023, 1, 1, 12)), 1000)
+
+    def test_outstanding_for_schedule_stream(self):
+        # GIVEN a schedule stream with a one hour cliff, then 2 per second
+        self.add_stream("s2", "alice", "bob", rate=2, begins="2023-01-01 00:00:00", closes="2023-01-02 00:00:00", schedule=[[0, 0, 0], [3600, 2, 0]])
+
+        # WHEN outstanding amounts are read before and after the cliff
+        # THEN only the time after the cliff accrues
+        self.assertEqual(self.cache.outstanding("s2", datetime.datetime(2023, 1, 1, 0, 30)), 0)
+        self.assertEqual(self.cache.outstanding("s2", datetime.datetime(2023, 1, 1, 1, 30)), 3600)
+
+    def test_outstanding_for_subscription(self):
+        # GIVEN a daily subscription of 100 with no close time
+        self.add_stream("s3", "alice", "bob", rate=100, begins="2023-01-01 00:00:00", closes=None, claimed=100)
+        self.node.set("currency.streams:s3:period", 86400)
+
+        # WHEN the outstanding amount is read on the third day
+        # THEN the second and third periods are due
+        self.assertEqual(self.cache.outstanding("s3", datetime.datetime(2023, 1, 3, 12)), 200)
+
+    def test_missing_and_inactive_streams(self):
+        # GIVEN a finalized stream and an unknown id
+        self.node.set("currency.streams:s1:status", "finalized")
+
+        # THEN neither has anything outstanding
+        self.assertEqual(self.cache.outstanding("s1", datetime.datetime(2023, 1, 1, 1)), 0)
+        self.assertIsNone(self.cache.stream("unknown"))
+
+    def test_outstanding_defaults_to_naive_utc_now(self):
+        # GIVEN a stream that began an hour ago, UTC
+        begins = utcnow() - datetime.timedelta(hours=1)
+        self.add_stream("s2", "alice", "bob", rate=1, begins=begins.strftime("%Y-%m-%d %H:%M:%S"), closes="2999-01-01 00:00:00")
+
+        # THEN the default time is naive and the stream has accrued about an hour
+        self.assertIsNone(utcnow().tzinfo)
+        self.assertAlmostEqual(self.cache.outstanding("s2"), 3600, delta=60)
+
+    def test_cache_evicts_least_recently_used(self):
+        # GIVEN a cache that holds two entries
+        cache = StreamCache(self.node.get_state, contract="currency", max_entries=2)
+        self.node.set("currency.balances:bob", 1)
+        self.node.set("currency.balances:carol", 2)
+
+        cache.balance_of("alice")
+        cache.balance_of("bob")
+        cache.balance_of("alice")
+
+        # WHEN a third entry is read
+        cache.balance_of("carol")
+
+        # THEN the least recently used entry is dropped
+        self.assertEqual(list(cache.entries), ["currency.balances:alice", "currency.balances:carol"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+from contracting.stdlib.bridge.time import Datetime
+from contracting.client import ContractingClient
+from xian_py.wallet import Wallet
+
+
+class TestStreamEngine(unittest.TestCase):
+    def setUp(self):
+        self.chain_id = "test-chain"
+        self.environment = {
+            "chain_id": self.chain_id
+        }
+
+        self.client = ContractingClient(environment=self.environment)
+        self.client.flush()
+
+        with open("token_xsc003.py") as f:
+            self.client.submit(f.read(), name="currency")
+            f.seek(0)
+            self.client.submit(f.read(), name="other_token")
+
+        with open("stream_engine.py") as f:
+            self.client.submit(f.read(), name="stream_engine")
+
+        self.currency = self.client.get_contract("currency")
+        self.other_token = self.client.get_contract("other_token")
+        self.engine = self.client.get_contract("stream_engine")
+
+        self.begins = Datetime(year=2023, month=1, day=1)
+        self.closes = Datetime(year=2023, month=1, day=2)
+
+    def tearDown(self):
+        self.client.flush()
+
+    def test_balance_stream_moves_funds_through_transfer_from(self):
+        # GIVEN a sender that approved the engine and opened a stream
+        self.currency.transfer(amount=100_000, to="alice", signer="sys")
+        self.currency.approve(amount=100_000, to="stream_engine", signer="alice")
+        stream_id = self.engine.create_stream(token="currency", receiver="bob", rate=1, begins=str(self.begins), closes=str(self.closes), signer="alice")
+
+        # WHEN the receiver balances the stream
+        self.engine.balance_stream(token="currency", stream_id=stream_id, signer="bob", environment={"now": self.closes})
+
+        # THEN the token balances and allowance should reflect the payout
+        self.assertEqual(self.currency.balances["bob"], 86400)
+        self.assertEqual(self.currency.balances["alice"], 100_000 - 86400)
+        self.assertEqual(self.currency.allowances["alice", "stream_engine"], 100_000 - 86400)
+        self.assertEqual(self.engine.streams["currency", stream_id, "claimed"], 86400)
+
+        # WHEN the stream is finalized
+        self.engine.finalize_stream(token="currency", stream_id=stream_id, signer="bob", environment={"now": self.closes})
+        # THEN it should be marked finalized
+        self.assertEqual(self.engine.streams["currency", stream_id, "status"], "finalized")
+
+    def test_streams_are_kept_per_token(self):
+        # GIVEN identical streams on two tokens
+        for token in (self.currency, self.other_token):
+            token.transfer(amount=100_000, to="alice", signer="sys")
+            token.approve(amount=100_000, to="stream_engine", signer="alice")
+        currency_id = self.engine.create_stream(token="currency", receiver="bob", rate=1, begins=str(self.begins), closes=str(self.closes), signer="alice")
+        other_id = self.engine.create_stream(token="other_token", receiver="bob", rate=1, begins=str(self.begins), closes=str(self.closes), signer="alice")
+
+        # WHEN only one of them is closed, balanced and finalized
+        self.engine.close_balance_finalize(token="currency", stream_id=currency_id, signer="alice", environment={"now": Datetime(year=2023, month=1, day=1, hour=1)})
+
+        # THEN only that token should move
+        self.assertNotEqual(currency_id, other_id)
+        self.assertEqual(self.currency.balances["bob"], 3600)
+        self.assertEqual(self.other_token.balances["bob"], 0)
+        self.assertEqual(self.engine.streams["currency", currency_id, "status"], "finalized")
+        self.assertEqual(self.engine.streams["other_token", other_id, "status"], "active")
+
+    def test_balance_stream_caps_at_sender_balance(self):
+        # GIVEN a sender with less balance than the stream owes
+        self.currency.transfer(amount=1000, to="alice", signer="sys")
+        self.currency.approve(amount=100_000, to="stream_engine", signer="alice")
+        stream_id = self.engine.create_stream(token="currency", receiver="bob", rate=1, begins=str(self.begins), closes=str(self.closes), signer="alice")
+
+        # WHEN the stream is balanced
+        self.engine.balance_stream(token="currency", stream_id=stream_id, signer="bob", environment={"now": self.closes})
+
+        # THEN only the available balance should be paid
+        self.assertEqual(self.currency.balances["bob"], 1000)
+        self.assertEqual(self.currency.balances["alice"], 0)
+
+    def test_balance_stream_caps_at_allowance(self):
+        # GIVEN a sender that approved the engine for less than the stream owes
+        self.currency.transfer(amount=100_000, to="alice", signer="sys")
+        self.currency.approve(amount=1000, to="stream_engine", signer="alice")
+        stream_id = self.engine.create_stream(token="currency", receiver="bob", rate=1, begins=str(self.begins), closes=str(self.closes), signer="alice")
+
+        # WHEN the stream is balanced
+        self.engine.balance_stream(token="currency", stream_id=stream_id, signer="bob", environment={"now": self.closes})
+
+        # THEN only the approved amount should be paid
+        self.assertEqual(self.currency.balances["bob"], 1000)
+        self.assertEqual(self.currency.allowances["alice", "stream_engine"], 0)
+        self.assertEqual(self.engine.streams["currency", stream_id, "claimed"], 1000)
+
+        # WHEN the sender approves the rest
+        self.currency.approve(amount=100_000, to="stream_engine", signer="alice")
+        self.engine.balance_finalize(token="currency", stream_id=stream_id, signer="bob", environment={"now": self.closes})
+
+        # THEN the stream can be settled in full and finalized
+        self.assertEqual(self.currency.balances["bob"], 86400)
+        self.assertEqual(self.engine.streams["currency", stream_id, "status"], "finalized")
+
+    def test_balance_stream_pays_nothing_without_approval(self):
+        # GIVEN a sender that never approved the engine
+        self.currency.transfer(amount=100_000, to="alice", signer="sys")
+        stream_id = self.engine.create_stream(token="currency", receiver="bob", rate=1, begins=str(self.begins), closes=str(self.closes), signer="alice")
+
+        # WHEN the stream is balanced
+        self.engine.balance_stream(token="currency", stream_id=stream_id, signer="bob", environment={"now": self.closes})
+
+        # THEN nothing moves
+        self.assertEqual(self.currency.balances["bob"], 0)
+        self.assertEqual(self.engine.streams["currency", stream_id, "claimed"], 0)
+
+    def test_create_stream_from_permit(self):
+        # GIVEN a permit signed for a token stream
+        wallet = Wallet('ed30796abc4ab47a97bfb37359f50a9c362c7b304a4b4ad1b3f5369ecb6f7fd8')
+        deadline = Datetime(year=2023, month=1, day=11)
+        msg = f"currency:{wallet.public_key}:bob:1:{self.begins}:{self.closes}:{deadline}:stream_engine:{self.chain_id}"
+        signature = wallet.sign_msg(msg)
+        env = {"now": Datetime(year=2023, month=1, day=1), "chain_id": self.chain_id}
+
+        # WHEN the stream is created from the permit
+        stream_id = self.engine.create_stream_from_permit(token="currency", sender=wallet.public_key, receiver="bob", rate=1, begins=str(self.begins), closes=str(self.closes), deadline=str(deadline), signature=signature, environment=env)
+
+        # THEN the stream should exist for that token
+        self.assertEqual(self.engine.streams["currency", stream_id, "sender"], wallet.public_key)
+
+        # WHEN the permit is replayed
+        # THEN it should fail
+        with self.assertRaises(AssertionError):
+            self.engine.create_stream_from_permit(token="currency", sender=wallet.public_key, receiver="bob", rate=1, begins=str(self.begins), closes=str(self.closes), deadline=str(deadline), signature=signature, environment=env)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,21 @@
 balances = Hash(default_value=0)
+allowances = Hash(default_value=0)
 metadata = Hash()
+total_supply = Variable()
+holder_count = Variable()
 # XST002
 permits = Hash()
 # XST003
 streams = Hash()
+close_buckets = Hash()
+close_bucket_heads = Hash(default_value=0)
+close_bucket_tails = Hash(default_value=0)
+stream_stats = Variable()
+stream_counter = Variable()
+incoming_streams = Hash()
+incoming_stream_heads = Hash(default_value=0)
+incoming_stream_tails = Hash(default_value=0)
+auto_settle = Hash(default_value=False)
 
 
 # XST001
@@ -11,6 +23,15 @@ streams = Hash()
 @construct
 def seed():
     balances[ctx.caller] = 1_000_000
+    total_supply.set(1_000_000)
+    holder_count.set(1)
+    stream_counter.set(0)
+    stream_stats.set({
+        ACTIVE_COUNT_KEY: 0,
+        ACTIVE_RATE_KEY: 0,
+        TOTAL_STREAMED_KEY: 0,
+        TOTAL_CLAIMED_KEY: 0,
+    })
 
     metadata['token_name'] = "TEST TOKEN"
     metadata['token_symbol'] = "TST"
@@ -28,10 +49,13 @@ def change_metadata(key: str, value: Any):
 @export
 def transfer(amount: float, to: str):
     assert amount > 0, 'Cannot send negative balances.'
+
+    settle_incoming(ctx.caller, amount)
+
     assert balances[ctx.caller] >= amount, 'Not enough coins to send.'
 
-    balances[ctx.caller] -= amount
-    balances[to] += amount
+    debit(ctx.caller, amount)
+    credit(to, amount)
 
     return f"Sent {amount} to {to}"
 
@@ -39,7 +63,7 @@ def transfer(amount: float, to: str):
 @export
 def approve(amount: float, to: str):
     assert amount >= 0, 'Cannot send negative balances.'
-    balances[ctx.caller, to] += amount
+    allowances[ctx.caller, to] += amount
 
     return f"Approved {amount} for {to}"
 
@@ -47,21 +71,120 @@ def approve(amount: float, to: str):
 @export
 def transfer_from(amount: float, to: str, main_account: str):
     assert amount > 0, 'Cannot send negative balances.'
-    assert balances[main_account, ctx.caller] >= amount, f'Not enough coins approved to send. You have {balances[main_account, ctx.caller]} and are trying to spend {amount}'
+    assert allowances[main_account, ctx.caller] >= amount, f'Not enough coins approved to send. You have {allowances[main_account, ctx.caller]} and are trying to spend {amount}'
+
+    settle_incoming(main_account, amount)
+
     assert balances[main_account] >= amount, 'Not enough coins to send.'
 
-    balances[main_account, ctx.caller] -= amount
-    balances[main_account] -= amount
-    balances[to] += amount
+    allowances[main_account, ctx.caller] -= amount
+    debit(main_account, amount)
+    credit(to, amount)
 
     return f"Sent {amount} to {to} from {main_account}"
 
 
+# Sends amounts[i] to recipients[i], checking and debiting the caller's balance once
+@export
+def transfer_many(recipients: list, amounts: list):
+    amounts = to_decimals(amounts)
+    total = calc_batch_total(recipients, amounts)
+
+    settle_incoming(ctx.caller, total)
+
+    assert balances[ctx.caller] >= total, 'Not enough coins to send.'
+
+    debit(ctx.caller, total)
+    for i in range(len(recipients)):
+        credit(recipients[i], amounts[i])
+
+    return f"Sent {total} to {len(recipients)} recipients"
+
+
+# Sends amounts[i] to recipients[i] from main_account, checking and debiting the allowance and balance once
+@export
+def transfer_from_many(recipients: list, amounts: list, main_account: str):
+    amounts = to_decimals(amounts)
+    total = calc_batch_total(recipients, amounts)
+
+    assert allowances[main_account, ctx.caller] >= total, f'Not enough coins approved to send. You have {allowances[main_account, ctx.caller]} and are trying to spend {total}'
+
+    settle_incoming(main_account, total)
+
+    assert balances[main_account] >= total, 'Not enough coins to send.'
+
+    allowances[main_account, ctx.caller] -= total
+    debit(main_account, total)
+    for i in range(len(recipients)):
+        credit(recipients[i], amounts[i])
+
+    return f"Sent {total} to {len(recipients)} recipients from {main_account}"
+
+
+def calc_batch_total(recipients: list, amounts: list) -> float:
+    assert len(recipients) > 0, 'No recipients given.'
+    assert len(recipients) == len(amounts), 'Recipients and amounts must have the same length.'
+
+    total = 0
+    for amount in amounts:
+        assert amount > 0, 'Cannot send negative balances.'
+        total += amount
+
+    return total
+
+
 @export 
 def balance_of(address: str):
     return balances[address]
 
 
+@export
+def get_total_supply():
+    return total_supply.get()
+
+
+@export
+def get_holder_count():
+    return holder_count.get()
+
+
+# Balance updates go through debit / credit so holder_count stays in step
+# with the number of non-zero balances
+def debit(address: str, amount: float):
+    balance = balances[address] - amount
+    balances[address] = balance
+
+    if amount > 0 and balance == 0:
+        holder_count.set(holder_count.get() - 1)
+
+
+def credit(address: str, amount: float):
+    balance = balances[address]
+    balances[address] = balance + amount
+
+    if amount > 0 and balance == 0:
+        holder_count.set(holder_count.get() + 1)
+
+
+# Opts ctx.caller in or out of settle-on-spend: when a transfer finds too little
+# balance, up to MAX_AUTO_SETTLE incoming streams are settled first
+@export
+def set_auto_settle(enabled: bool):
+    auto_settle[ctx.caller] = enabled
+
+    return f"Auto settle {'enabled' if enabled else 'disabled'} for {ctx.caller}"
+
+
+@export
+def get_stream_stats():
+    return stream_stats.get()
+
+
+@export
+def allowance(owner: str, spender: str):
+    return allowances[owner, spender]
+
+
 # XST002 / Permit
 
 @export
@@ -74,7 +197,7 @@ def permit(owner: str, spender: str, value: float, deadline: str, signature: str
     assert now < deadline, 'Permit has expired.'
     assert crypto.verify(owner, permit_msg, signature), 'Invalid signature.'
 
-    balances[owner, spender] += value
+    allowances[owner, spender] += value
     permits[permit_hash] = True
 
     return f"Permit granted for {value} to {spender} from {owner}"
@@ -94,9 +217,19 @@ BEGIN_KEY = "begins"
 CLOSE_KEY = "closes"
 RATE_KEY = "rate"
 CLAIMED_KEY = "claimed"
+SCHEDULE_KEY = "schedule"
+DEPOSIT_KEY = "deposit"
+PERIOD_KEY = "period"
 STREAM_ACTIVE = "active"
 STREAM_FINALIZED = "finalized"
 STREAM_FORFEIT = "forfeit"
+STREAM_MERGED = "merged"
+MERGED_INTO_KEY = "merged_into"
+MAX_AUTO_SETTLE = 5
+ACTIVE_COUNT_KEY = "active_count"
+ACTIVE_RATE_KEY = "active_rate"
+TOTAL_STREAMED_KEY = "total_streamed"
+TOTAL_CLAIMED_KEY = "total_claimed"
 
 
 # Creates a new stream to a receiver from ctx.caller
@@ -112,12 +245,65 @@ def create_stream(receiver: str, rate: float, begins: str, closes: str):
     return stream_id
 
 
+# Creates a stream that is funded up front: rate * (closes - begins) is moved from the
+# sender's balance into the stream's deposit, and settlements are paid from the deposit
+# Wrapper for perform_create_stream
+@export
+def create_escrow_stream(receiver: str, rate: float, begins: str, closes: str):
+    begins = strptime_ymdhms(begins)
+    closes = strptime_ymdhms(closes)
+    sender = ctx.caller
+
+    stream_id = perform_create_stream(sender, receiver, rate, begins, closes, None, True)
+    return stream_id
+
+
+# Creates a stream whose rate changes over time, e.g. a cliff followed by a linear release
+# `starts` and `rates` describe segments: rates[i] applies from starts[i] until starts[i + 1],
+# and the last rate applies until the stream closes
+# starts[0] must equal begins, starts must be increasing and the last rate must be greater than 0
+# Wrapper for perform_create_stream
+@export
+def create_schedule_stream(receiver: str, begins: str, closes: str, starts: list, rates: list):
+    begins = strptime_ymdhms(begins)
+    closes = strptime_ymdhms(closes)
+    sender = ctx.caller
+
+    schedule = build_schedule(begins, closes, starts, rates)
+
+    stream_id = perform_create_stream(sender, receiver, schedule[-1][1], begins, closes, schedule)
+    return stream_id
+
+
+# Creates a subscription that charges `amount` at the start of every `period` seconds from `begins`
+# It renews on its own, with no transaction per period, until `max_periods` periods
+# have been charged or it is cancelled; without `max_periods` it has no close time
+# Wrapper for perform_create_stream
+@export
+def create_subscription_stream(receiver: str, amount: float, period: int, begins: str, max_periods: int = None):
+    begins = strptime_ymdhms(begins)
+    sender = ctx.caller
+
+    assert period > 0, 'Period must be greater than 0.'
+
+    closes = None
+    if max_periods is not None:
+        assert max_periods > 0, 'Max periods must be greater than 0.'
+        closes = begins + datetime.timedelta(seconds=period * max_periods)
+
+    stream_id = perform_create_stream(sender, receiver, amount, begins, closes, period=period)
+    return stream_id
+
+
 # Internal function used to create a stream from a permit or from a direct call from the sender
-def perform_create_stream(sender: str, receiver: str, rate: float, begins: str, closes: str):
-    stream_id = hashlib.sha3(f"{sender}:{receiver}:{begins}:{closes}:{rate}")
-    
+# Streams get the next sequential ID unless one is given, as for permit-created streams
+# Only subscriptions (`period` set) may have no close time
+def perform_create_stream(sender: str, receiver: str, rate: float, begins: str, closes: str, schedule: list = None, escrow: bool = False, stream_id: str = None, period: int = None):
+    if stream_id is None:
+        stream_id = next_stream_id()
+
     assert streams[stream_id, STATUS_KEY] is None, 'Stream already exists.'
-    assert begins < closes, 'Stream cannot begin after the close date.'
+    assert closes is None or begins < closes, 'Stream cannot begin after the close date.'
     assert rate > 0, 'Rate must be greater than 0.'
 
     streams[stream_id, STATUS_KEY] = STREAM_ACTIVE
@@ -128,9 +314,77 @@ def perform_create_stream(sender: str, receiver: str, rate: float, begins: str,
     streams[stream_id, RATE_KEY] = rate
     streams[stream_id, CLAIMED_KEY] = 0
 
+    if schedule is not None:
+        streams[stream_id, SCHEDULE_KEY] = schedule
+
+    if period is not None:
+        streams[stream_id, PERIOD_KEY] = period
+
+    if escrow:
+        deposit = calc_total_accrued(begins, closes, rate, schedule)
+
+        assert balances[sender] >= deposit, 'Not enough coins to fund the stream.'
+
+        debit(sender, deposit)
+        streams[stream_id, DEPOSIT_KEY] = deposit
+
+    if closes is not None:
+        add_to_close_bucket(stream_id, closes)
+        committed = calc_total_accrued(begins, closes, rate, schedule, period)
+    else:
+        committed = 0
+
+    add_incoming_stream(receiver, stream_id)
+    record_stream_stats(1, calc_active_rate(rate, period), committed, 0)
+
     return stream_id
 
 
+# Each receiver's streams are a queue stored one entry per key,
+# `incoming_streams[receiver, i]` for head <= i < tail, so adding one is a single write
+def add_incoming_stream(receiver: str, stream_id: str):
+    tail = incoming_stream_tails[receiver]
+    incoming_streams[receiver, tail] = stream_id
+    incoming_stream_tails[receiver] = tail + 1
+
+
+# Compact IDs from a global counter: "1", "2", ...
+def next_stream_id() -> str:
+    count = stream_counter.get() + 1
+    stream_counter.set(count)
+    return str(count)
+
+
+# Turns segment start times and rates into [offset, rate, accrued] entries, where offset is
+# seconds since begins and accrued is the amount streamed before the segment starts
+def build_schedule(begins: datetime.datetime, closes: datetime.datetime, starts: list, rates: list) -> list:
+    assert len(starts) > 0, 'Schedule must have at least one segment.'
+    assert len(starts) == len(rates), 'Schedule must have one rate per segment start.'
+
+    schedule = []
+    accrued = 0
+    previous = None
+
+    for i in range(len(starts)):
+        start = strptime_ymdhms(starts[i])
+        rate = to_decimal(rates[i])
+
+        assert rate >= 0, 'Rate must not be negative.'
+
+        if previous is None:
+            assert start == begins, 'Schedule must start when the stream begins.'
+        else:
+            assert start > previous, 'Schedule segments must be in order.'
+            accrued += schedule[-1][1] * int((start - previous).seconds)
+
+        assert start < closes, 'Schedule segments must start before the close date.'
+
+        schedule.append([int((start - begins).seconds), rate, accrued])
+        previous = start
+
+    return schedule
+
+
 # Creates a payment stream from a valid signature of a permit message
 # Wrapper for perform_create_stream
 @export
@@ -148,39 +402,24 @@ def create_stream_from_permit(sender: str, receiver: str, rate: float, begins: s
 
     permits[permit_hash] = True
 
-    return perform_create_stream(sender, receiver, rate, begins, closes)
+    # Permit-created streams keep a deterministic ID so the signer knows it in advance
+    stream_id = hashlib.sha3(f"{sender}:{receiver}:{begins}:{closes}:{rate}")
+
+    return perform_create_stream(sender, receiver, rate, begins, closes, stream_id=stream_id)
 
 
 # Moves balance due from stream from sender to receiver.
 # Called by `sender` or `receiver`
 @export
 def balance_stream(stream_id: str):
-    assert streams[stream_id, STATUS_KEY], 'Stream does not exist.'
-    assert streams[stream_id, STATUS_KEY] == STREAM_ACTIVE, 'You can only balance active streams.'
-    assert now > streams[stream_id, BEGIN_KEY], 'Stream has not started yet.'
-
-    sender = streams[stream_id, SENDER_KEY]
-    receiver = streams[stream_id, RECEIVER_KEY]
-
-    assert ctx.caller in [sender, receiver], 'Only sender or receiver can balance a stream.'
+    stream = load_stream(stream_id)
 
-    closes = streams[stream_id, CLOSE_KEY]
-    begins = streams[stream_id, BEGIN_KEY]
-    rate = streams[stream_id, RATE_KEY]
-    claimed = streams[stream_id, CLAIMED_KEY]
-
-    # Calculate the amount of tokens that can be claimed
-    
-    outstanding_balance = calc_outstanding_balance(begins, closes, rate, claimed)
-    
-    assert outstanding_balance > 0, 'No amount due on this stream.'
+    assert stream[STATUS_KEY] == STREAM_ACTIVE, 'You can only balance active streams.'
+    assert ctx.caller in [stream[SENDER_KEY], stream[RECEIVER_KEY]], 'Only sender or receiver can balance a stream.'
 
-    claimable_amount = calc_claimable_amount(outstanding_balance, sender)
+    claimable_amount = settle_stream(stream)
 
-    balances[sender] -= claimable_amount
-    balances[receiver] += claimable_amount
-
-    streams[stream_id, CLAIMED_KEY] += claimable_amount
+    store_settlement(stream_id, stream)
 
     return f"Claimed {claimable_amount} tokens from stream"
 
@@ -193,21 +432,43 @@ def balance_stream(stream_id: str):
 def change_close_time(stream_id: str, new_close_time: str):
     new_close_time = strptime_ymdhms(new_close_time)
 
-    assert streams[stream_id, STATUS_KEY], 'Stream does not exist.'
-    assert streams[stream_id, STATUS_KEY] == STREAM_ACTIVE, 'Stream is not active.'
+    stream = load_stream(stream_id)
 
-    sender = streams[stream_id, SENDER_KEY]
+    assert stream[STATUS_KEY] == STREAM_ACTIVE, 'Stream is not active.'
+    assert ctx.caller == stream[SENDER_KEY], 'Only sender can extend the close time of a stream.'
 
-    assert ctx.caller == sender, 'Only sender can extend the close time of a stream.'
+    closes = calc_close_time(stream[BEGIN_KEY], new_close_time)
+    move_close_bucket(stream_id, stream[CLOSE_KEY], closes)
+    set_close_time(stream, closes)
+    streams[stream_id, CLOSE_KEY] = closes
 
-    if new_close_time < streams[stream_id, BEGIN_KEY] and now < streams[stream_id, BEGIN_KEY]:
-        streams[stream_id, CLOSE_KEY] = streams[stream_id, BEGIN_KEY]
-    elif new_close_time <= now:
-        streams[stream_id, CLOSE_KEY] = now
-    else:
-        streams[stream_id, CLOSE_KEY] = new_close_time
+    if stream[DEPOSIT_KEY] is not None:
+        rebalance_deposit(stream)
+        streams[stream_id, DEPOSIT_KEY] = stream[DEPOSIT_KEY]
 
-    return f"Changed close time of stream to {streams[stream_id, CLOSE_KEY]}"
+    return f"Changed close time of stream to {closes}"
+
+
+# Ends a subscription with the period running now, which has already been charged
+# A subscription that has not begun yet ends before it charges anything
+# Called by `sender` or `receiver`
+@export
+def cancel_subscription(stream_id: str):
+    stream = load_stream(stream_id)
+
+    assert stream[STATUS_KEY] == STREAM_ACTIVE, 'Stream is not active.'
+    assert stream[PERIOD_KEY] is not None, 'Stream is not a subscription.'
+    assert ctx.caller in [stream[SENDER_KEY], stream[RECEIVER_KEY]], 'Only sender or receiver can cancel a subscription.'
+
+    closes = calc_period_end(stream[BEGIN_KEY], stream[PERIOD_KEY])
+    if stream[CLOSE_KEY] is not None and stream[CLOSE_KEY] < closes:
+        closes = stream[CLOSE_KEY]
+
+    move_close_bucket(stream_id, stream[CLOSE_KEY], closes)
+    set_close_time(stream, closes)
+    streams[stream_id, CLOSE_KEY] = closes
+
+    return f"Cancelled subscription, it ends at {closes}"
 
 
 # Set the stream inactive.
@@ -217,62 +478,400 @@ def change_close_time(stream_id: str, new_close_time: str):
 # Called by : `sender` or `receiver`
 @export
 def finalize_stream(stream_id: str):
-    assert streams[stream_id, STATUS_KEY], 'Stream does not exist.'
-    assert streams[stream_id, STATUS_KEY] == STREAM_ACTIVE, 'Stream is not active.'
-
-    sender = streams[stream_id, "sender"]
-    receiver = streams[stream_id, "receiver"]
-
-    assert ctx.caller in [sender, receiver], 'Only sender or receiver can finalize a stream.'
+    stream = load_stream(stream_id)
 
-    begins = streams[stream_id, BEGIN_KEY]
-    closes = streams[stream_id, CLOSE_KEY]
-    rate = streams[stream_id, RATE_KEY]
-    claimed = streams[stream_id, CLAIMED_KEY]
+    assert stream[STATUS_KEY] == STREAM_ACTIVE, 'Stream is not active.'
+    assert ctx.caller in [stream[SENDER_KEY], stream[RECEIVER_KEY]], 'Only sender or receiver can finalize a stream.'
 
-    assert closes <= now, 'Stream has not closed yet.'
+    assert_finalizable(stream)
 
-    outstanding_balance = calc_outstanding_balance(begins, closes, rate, claimed)
-
-    assert outstanding_balance == 0, 'Stream has outstanding balance.'
-
-    streams[stream_id, STATUS_KEY] = STREAM_FINALIZED
+    mark_finalized(stream_id, stream)
 
     return f"Finalized stream {stream_id}"
 
 
 # Convenience method to close a stream, balance it and finalize it
+# Loads the stream once and writes it back once, with the same checks as
+# calling change_close_time, balance_stream and finalize_stream in turn
 # Called by `sender`
 @export
 def close_balance_finalize(stream_id: str):
-    change_close_time(stream_id=stream_id, new_close_time=str(now))
-    balance_finalize(stream_id=stream_id)
+    stream = load_stream(stream_id)
+
+    assert stream[STATUS_KEY] == STREAM_ACTIVE, 'Stream is not active.'
+    assert ctx.caller == stream[SENDER_KEY], 'Only sender can extend the close time of a stream.'
+
+    set_close_time(stream, calc_close_time(stream[BEGIN_KEY], now))
+    if stream[DEPOSIT_KEY] is not None:
+        rebalance_deposit(stream)
+    settle_stream(stream)
+    assert_finalizable(stream)
+
+    streams[stream_id, CLOSE_KEY] = stream[CLOSE_KEY]
+    store_settlement(stream_id, stream)
+    mark_finalized(stream_id, stream)
+
+    return f"Finalized stream {stream_id}"
 
 
 # Convenience method to balance a stream and finalize it
+# Loads the stream once and writes it back once, with the same checks as
+# calling balance_stream and finalize_stream in turn
 # Called by `receiver` or `sender`
 @export
 def balance_finalize(stream_id: str):
-    balance_stream(stream_id=stream_id)
-    finalize_stream(stream_id=stream_id)
+    stream = load_stream(stream_id)
+
+    assert stream[STATUS_KEY] == STREAM_ACTIVE, 'You can only balance active streams.'
+    assert ctx.caller in [stream[SENDER_KEY], stream[RECEIVER_KEY]], 'Only sender or receiver can balance a stream.'
+
+    settle_stream(stream)
+    assert_finalizable(stream)
+
+    store_settlement(stream_id, stream)
+    mark_finalized(stream_id, stream)
+
+    return f"Finalized stream {stream_id}"
+
+
+# Settles and finalizes up to `max_count` expired streams in a close-time bucket
+# `bucket` is an hour in the format `%Y-%m-%d %H`, e.g. `2023-01-01 10`
+# Entries are taken from the head of the bucket. Streams that are no longer active
+# or now close in another hour are dropped. Streams that have not closed yet, and
+# streams the sender cannot fully cover once settled as far as possible, are moved
+# to the tail for a later sweep
+# Called by anyone
+@export
+def finalize_expired(bucket: str, max_count: int):
+    assert max_count > 0, 'Max count must be greater than 0.'
+
+    head = close_bucket_heads[bucket]
+    tail = close_bucket_tails[bucket]
+
+    assert head < tail, 'No streams in this bucket.'
+
+    end = min(head + max_count, tail)
+    kept = []
+    finalized = 0
+
+    for i in range(head, end):
+        stream_id = close_buckets[bucket, i]
+        close_buckets[bucket, i] = None
+        stream = load_stream(stream_id)
+
+        if stream[STATUS_KEY] != STREAM_ACTIVE or calc_close_bucket(stream[CLOSE_KEY]) != bucket:
+            continue
+
+        if stream[CLOSE_KEY] > now:
+            kept.append(stream_id)
+            continue
+
+        outstanding_balance = calc_stream_outstanding(stream)
+
+        if outstanding_balance > 0:
+            claimable_amount = pay_stream(stream, outstanding_balance)
+            store_settlement(stream_id, stream)
+
+            if claimable_amount < outstanding_balance:
+                kept.append(stream_id)
+                continue
+
+        mark_finalized(stream_id, stream)
+        finalized += 1
+
+    close_bucket_heads[bucket] = end
+
+    for stream_id in kept:
+        add_to_close_bucket(stream_id, bucket=bucket)
+
+    return f"Finalized {finalized} streams"
+
 
 # Forfeit a stream to the sender
 # Called by `receiver`
 @export
 def forfeit_stream(stream_id: str) -> str:
-    assert streams[stream_id, STATUS_KEY], 'Stream does not exist.'
-    assert streams[stream_id, STATUS_KEY] == STREAM_ACTIVE, 'Stream is not active.'
-
-    receiver = streams[stream_id, RECEIVER_KEY]
+    stream = load_stream(stream_id)
 
-    assert ctx.caller == receiver, 'Only receiver can forfeit a stream.'
+    assert stream[STATUS_KEY] == STREAM_ACTIVE, 'Stream is not active.'
+    assert ctx.caller == stream[RECEIVER_KEY], 'Only receiver can forfeit a stream.'
 
     streams[stream_id, STATUS_KEY] = STREAM_FORFEIT
     streams[stream_id, CLOSE_KEY] = now
 
+    # Nothing more will be paid out, so the stream's committed value becomes what was claimed
+    record_stream_stats(-1, -calc_active_rate(stream[RATE_KEY], stream[PERIOD_KEY]), stream[CLAIMED_KEY] - calc_committed(stream), 0)
+
+    # Whatever is left in an escrow deposit goes back to the sender
+    deposit = stream[DEPOSIT_KEY]
+    if deposit:
+        credit(stream[SENDER_KEY], deposit)
+        streams[stream_id, DEPOSIT_KEY] = 0
+
     return f"Forfeit stream {stream_id}"
 
 
+# Folds several streams between the same sender and receiver into one new stream
+# Each stream is settled first, then the new stream pays exactly what the originals
+# would have: the combined rate, or a schedule where their windows or rates differ.
+# It carries their combined claimed amount (and deposit for escrow streams), and the
+# originals are marked merged with a pointer to it
+# Called by `sender` or `receiver`
+@export
+def merge_streams(stream_ids: list):
+    assert len(stream_ids) > 1, 'At least two streams are needed to merge.'
+    assert len(set(stream_ids)) == len(stream_ids), 'Streams can only be merged once.'
+
+    loaded = []
+    for stream_id in stream_ids:
+        stream = load_stream(stream_id)
+        assert stream[STATUS_KEY] == STREAM_ACTIVE, 'You can only merge active streams.'
+        loaded.append(stream)
+
+    sender = loaded[0][SENDER_KEY]
+    receiver = loaded[0][RECEIVER_KEY]
+    escrow = loaded[0][DEPOSIT_KEY] is not None
+
+    assert ctx.caller in [sender, receiver], 'Only sender or receiver can merge streams.'
+
+    begins = loaded[0][BEGIN_KEY]
+    closes = loaded[0][CLOSE_KEY]
+
+    for stream in loaded:
+        assert stream[SENDER_KEY] == sender and stream[RECEIVER_KEY] == receiver, 'Streams must have the same sender and receiver.'
+        assert (stream[DEPOSIT_KEY] is not None) == escrow, 'Cannot merge escrow and non-escrow streams.'
+        assert stream[PERIOD_KEY] is None, 'Subscriptions cannot be merged.'
+
+        if stream[BEGIN_KEY] < begins:
+            begins = stream[BEGIN_KEY]
+        if stream[CLOSE_KEY] > closes:
+            closes = stream[CLOSE_KEY]
+
+    assert begins < closes, 'Stream cannot begin after the close date.'
+
+    claimed = 0
+    deposit = 0
+
+    for stream in loaded:
+        if now > stream[BEGIN_KEY]:
+            outstanding_balance = calc_stream_outstanding(stream)
+
+            if outstanding_balance > 0:
+                pay_stream(stream, outstanding_balance)
+
+        claimed += stream[CLAIMED_KEY]
+        if escrow:
+            deposit += stream[DEPOSIT_KEY]
+
+    schedule = merge_schedules(begins, closes, loaded)
+    rate = schedule[-1][1]
+
+    if len(schedule) == 1:
+        schedule = None
+
+    merged_id = perform_create_stream(sender, receiver, rate, begins, closes, schedule)
+    streams[merged_id, CLAIMED_KEY] = claimed
+    if escrow:
+        streams[merged_id, DEPOSIT_KEY] = deposit
+
+    for i in range(len(stream_ids)):
+        stream = loaded[i]
+
+        # The merged stream took over what these streams commit to
+        total = calc_total_accrued(stream[BEGIN_KEY], stream[CLOSE_KEY], stream[RATE_KEY], stream[SCHEDULE_KEY])
+        record_stream_stats(-1, -stream[RATE_KEY], -total, 0)
+
+        if escrow:
+            stream[DEPOSIT_KEY] = 0
+
+        streams[stream_ids[i], STATUS_KEY] = STREAM_MERGED
+        streams[stream_ids[i], MERGED_INTO_KEY] = merged_id
+        store_settlement(stream_ids[i], stream)
+
+    return merged_id
+
+
+# Reads every field of a stream in one go so compound operations can check
+# and settle it in memory, then write back only what changed
+def load_stream(stream_id: str) -> dict:
+    status = streams[stream_id, STATUS_KEY]
+
+    assert status, 'Stream does not exist.'
+
+    return {
+        STATUS_KEY: status,
+        SENDER_KEY: streams[stream_id, SENDER_KEY],
+        RECEIVER_KEY: streams[stream_id, RECEIVER_KEY],
+        BEGIN_KEY: streams[stream_id, BEGIN_KEY],
+        CLOSE_KEY: streams[stream_id, CLOSE_KEY],
+        RATE_KEY: streams[stream_id, RATE_KEY],
+        CLAIMED_KEY: streams[stream_id, CLAIMED_KEY],
+        SCHEDULE_KEY: streams[stream_id, SCHEDULE_KEY],
+        DEPOSIT_KEY: streams[stream_id, DEPOSIT_KEY],
+        PERIOD_KEY: streams[stream_id, PERIOD_KEY],
+    }
+
+
+# Writes back what settling a loaded stream changed
+def store_settlement(stream_id: str, stream: dict):
+    streams[stream_id, CLAIMED_KEY] = stream[CLAIMED_KEY]
+
+    if stream[DEPOSIT_KEY] is not None:
+        streams[stream_id, DEPOSIT_KEY] = stream[DEPOSIT_KEY]
+
+
+# Pays out what is due on a loaded stream and records it in stream[CLAIMED_KEY].
+# The caller is responsible for writing the claimed amount back to `streams`
+def settle_stream(stream: dict) -> float:
+    assert now > stream[BEGIN_KEY], 'Stream has not started yet.'
+
+    outstanding_balance = calc_stream_outstanding(stream)
+
+    assert outstanding_balance > 0, 'No amount due on this stream.'
+
+    return pay_stream(stream, outstanding_balance)
+
+
+# Pays as much of `outstanding_balance` as the sender can cover, or as the
+# deposit holds for escrow streams
+def pay_stream(stream: dict, outstanding_balance: float) -> float:
+    deposit = stream[DEPOSIT_KEY]
+
+    if deposit is None:
+        claimable_amount = calc_claimable_amount(outstanding_balance, stream[SENDER_KEY])
+        debit(stream[SENDER_KEY], claimable_amount)
+    else:
+        claimable_amount = outstanding_balance if outstanding_balance < deposit else deposit
+        stream[DEPOSIT_KEY] = deposit - claimable_amount
+
+    credit(stream[RECEIVER_KEY], claimable_amount)
+
+    # Subscriptions without a close time commit value as they are paid
+    if stream[CLOSE_KEY] is None:
+        record_stream_stats(0, 0, claimable_amount, claimable_amount)
+    else:
+        record_stream_stats(0, 0, 0, claimable_amount)
+
+    stream[CLAIMED_KEY] += claimable_amount
+
+    return claimable_amount
+
+
+def assert_finalizable(stream: dict):
+    assert stream[CLOSE_KEY] is not None and stream[CLOSE_KEY] <= now, 'Stream has not closed yet.'
+
+    outstanding_balance = calc_stream_outstanding(stream)
+
+    assert outstanding_balance == 0, 'Stream has outstanding balance.'
+
+
+# Settle-on-spend: if `account` opted in and holds less than `amount`, settles its
+# incoming streams from the head of its queue until the amount is covered or
+# MAX_AUTO_SETTLE streams have been looked at. Streams with nothing to settle stay
+# where they are, with no writes. Streams that are no longer active are dropped,
+# and streams that were paid are moved to the tail so the next spend gets to others
+def settle_incoming(account: str, amount: float):
+    if balances[account] >= amount or not auto_settle[account]:
+        return
+
+    first = incoming_stream_heads[account]
+    end = min(first + MAX_AUTO_SETTLE, incoming_stream_tails[account])
+    head = first
+    settled = []
+
+    for i in range(first, end):
+        if balances[account] >= amount:
+            continue
+
+        stream_id = incoming_streams[account, i]
+        stream = load_stream(stream_id)
+
+        if stream[STATUS_KEY] == STREAM_ACTIVE:
+            if now <= stream[BEGIN_KEY]:
+                continue
+
+            outstanding_balance = calc_stream_outstanding(stream)
+
+            if outstanding_balance <= 0:
+                continue
+
+            claimable_amount = pay_stream(stream, outstanding_balance)
+            store_settlement(stream_id, stream)
+
+            if claimable_amount <= 0:
+                continue
+
+            settled.append(stream_id)
+
+        # Removes entry i without leaving a gap: the head entry, already looked at,
+        # takes its slot and the head moves up by one
+        if i != head:
+            incoming_streams[account, i] = incoming_streams[account, head]
+        incoming_streams[account, head] = None
+        head += 1
+
+    if head != first:
+        incoming_stream_heads[account] = head
+
+    for stream_id in settled:
+        add_incoming_stream(account, stream_id)
+
+
+def mark_finalized(stream_id: str, stream: dict):
+    streams[stream_id, STATUS_KEY] = STREAM_FINALIZED
+    record_stream_stats(-1, -calc_active_rate(stream[RATE_KEY], stream[PERIOD_KEY]), 0, 0)
+
+
+# Moves a loaded stream's close time and the committed value in stream_stats with it
+def set_close_time(stream: dict, closes: datetime.datetime):
+    old_total = calc_committed(stream)
+    new_total = calc_total_accrued(stream[BEGIN_KEY], closes, stream[RATE_KEY], stream[SCHEDULE_KEY], stream[PERIOD_KEY])
+
+    stream[CLOSE_KEY] = closes
+    record_stream_stats(0, 0, new_total - old_total, 0)
+
+
+# Protocol-wide counters, kept in one Variable so they can be read with a single key:
+# number of active streams, sum of their final rates, value committed to all streams
+# (what they pay out by their close time) and value actually paid out
+# A schedule stream counts its last segment's rate from creation, so active_rate
+# overstates the current flow while such a stream is in a cliff or a lower-rate
+# segment. Keeping it current would need a write at every segment boundary
+def record_stream_stats(active_count: int, active_rate: float, streamed: float, claimed: float):
+    stats = stream_stats.get()
+
+    stats[ACTIVE_COUNT_KEY] += active_count
+    stats[ACTIVE_RATE_KEY] += active_rate
+    stats[TOTAL_STREAMED_KEY] += streamed
+    stats[TOTAL_CLAIMED_KEY] += claimed
+
+    stream_stats.set(stats)
+
+
+# Keeps an escrow deposit equal to what is still due until the stream closes,
+# refunding the sender when the close time moves earlier and topping it up when it moves later
+def rebalance_deposit(stream: dict):
+    sender = stream[SENDER_KEY]
+    required = calc_total_accrued(stream[BEGIN_KEY], stream[CLOSE_KEY], stream[RATE_KEY], stream[SCHEDULE_KEY]) - stream[CLAIMED_KEY]
+    difference = required - stream[DEPOSIT_KEY]
+
+    if difference > 0:
+        assert balances[sender] >= difference, 'Not enough coins to fund the stream.'
+        debit(sender, difference)
+    elif difference < 0:
+        credit(sender, -difference)
+
+    stream[DEPOSIT_KEY] = required
+
+
+def calc_close_time(begins: datetime.datetime, new_close_time: datetime.datetime) -> datetime.datetime:
+    if new_close_time < begins and now < begins:
+        return begins
+    if new_close_time <= now:
+        return now
+    return new_close_time
+
+
 def calc_outstanding_balance(begins: str, closes: str, rate: float, claimed: float) -> float:
 
     claimable_end_point = now if now < closes else closes
@@ -282,8 +881,199 @@ def calc_outstanding_balance(begins: str, closes: str, rate: float, claimed: flo
     return amount_due
 
 
+# Active streams are indexed by the hour they close in, so expired streams can be
+# found and finalized without scanning `streams`. Each bucket is a queue stored one
+# entry per key, `close_buckets[bucket, i]` for head <= i < tail, so adding a stream
+# is a single write. Entries for streams that are no longer active or were moved to
+# another hour are dropped lazily by finalize_expired
+def calc_close_bucket(closes: datetime.datetime) -> str:
+    return str(closes)[:13]
+
+
+def add_to_close_bucket(stream_id: str, closes: datetime.datetime = None, bucket: str = None):
+    if bucket is None:
+        bucket = calc_close_bucket(closes)
+
+    tail = close_bucket_tails[bucket]
+    close_buckets[bucket, tail] = stream_id
+    close_bucket_tails[bucket] = tail + 1
+
+
+def move_close_bucket(stream_id: str, old_closes: datetime.datetime, new_closes: datetime.datetime):
+    if old_closes is not None and calc_close_bucket(old_closes) == calc_close_bucket(new_closes):
+        return
+
+    add_to_close_bucket(stream_id, new_closes)
+
+
+def calc_stream_outstanding(stream: dict) -> float:
+    if stream[PERIOD_KEY] is not None:
+        return calc_subscription_outstanding(stream[BEGIN_KEY], stream[CLOSE_KEY], stream[RATE_KEY], stream[PERIOD_KEY], stream[CLAIMED_KEY])
+
+    if stream[SCHEDULE_KEY] is None:
+        return calc_outstanding_balance(stream[BEGIN_KEY], stream[CLOSE_KEY], stream[RATE_KEY], stream[CLAIMED_KEY])
+
+    return calc_scheduled_outstanding(stream[BEGIN_KEY], stream[CLOSE_KEY], stream[SCHEDULE_KEY], stream[CLAIMED_KEY])
+
+
+# Closed form accrual for piecewise-rate streams: binary search for the segment
+# that contains the claimable end point, then add its partial accrual to the
+# amount accrued before it started
+def calc_scheduled_outstanding(begins: str, closes: str, schedule: list, claimed: float) -> float:
+    claimable_end_point = now if now < closes else closes
+    elapsed = (claimable_end_point - begins).seconds
+
+    amount_due = calc_scheduled_accrued(schedule, elapsed) - claimed
+    return amount_due
+
+
+def calc_scheduled_accrued(schedule: list, elapsed: float) -> float:
+    low = 0
+    high = len(schedule) - 1
+    while low < high:
+        mid = (low + high + 1) // 2
+        if schedule[mid][0] <= elapsed:
+            low = mid
+        else:
+            high = mid - 1
+
+    offset = schedule[low][0]
+    rate = schedule[low][1]
+    accrued = schedule[low][2]
+
+    return accrued + (rate * (elapsed - offset))
+
+
+# Closed form accrual for subscriptions: `amount` for every period that has started by
+# the claimable end point, and no more than the periods that start before closes
+def calc_subscription_outstanding(begins: str, closes: str, amount: float, period: int, claimed: float) -> float:
+    claimable_end_point = now if closes is None or now < closes else closes
+
+    amount_due = calc_subscription_accrued(begins, closes, amount, period, claimable_end_point) - claimed
+    return amount_due
+
+
+def calc_subscription_accrued(begins: str, closes: str, amount: float, period: int, end: str) -> float:
+    if end < begins:
+        return 0
+
+    periods = int((end - begins).seconds) // period + 1
+
+    if closes is not None:
+        charged = (int((closes - begins).seconds) + period - 1) // period
+        if periods > charged:
+            periods = charged
+
+    return amount * periods
+
+
+# End of the subscription period that is running now, or begins if none has started
+def calc_period_end(begins: datetime.datetime, period: int) -> datetime.datetime:
+    if now < begins:
+        return begins
+
+    periods = int((now - begins).seconds) // period + 1
+    return begins + datetime.timedelta(seconds=period * periods)
+
+
+# Subscriptions charge per period rather than per second, so they are left out of
+# the active_rate statistic
+def calc_active_rate(rate: float, period: int) -> float:
+    if period is not None:
+        return 0
+    return rate
+
+
+# Value a stream is committed to in stream_stats: everything it pays out by its close
+# time, or what it has paid so far for a subscription with no close time
+def calc_committed(stream: dict) -> float:
+    if stream[CLOSE_KEY] is None:
+        return stream[CLAIMED_KEY]
+
+    return calc_total_accrued(stream[BEGIN_KEY], stream[CLOSE_KEY], stream[RATE_KEY], stream[SCHEDULE_KEY], stream[PERIOD_KEY])
+
+
+# Everything a stream pays out between begins and closes
+def calc_total_accrued(begins: str, closes: str, rate: float, schedule: list, period: int = None) -> float:
+    if period is not None:
+        return calc_subscription_accrued(begins, closes, rate, period, closes)
+
+    seconds = (closes - begins).seconds
+
+    if schedule is None:
+        return rate * seconds
+
+    return calc_scheduled_accrued(schedule, seconds)
+
+
+# Schedule of the sum of `merged` streams, as [offset, rate, accrued] entries relative to
+# `begins`: a segment starts wherever one of the streams begins, closes or changes rate
+def merge_schedules(begins: datetime.datetime, closes: datetime.datetime, merged: list) -> list:
+    end = int((closes - begins).seconds)
+    offsets = set()
+
+    for stream in merged:
+        start = int((stream[BEGIN_KEY] - begins).seconds)
+        offsets.add(start)
+        offsets.add(int((stream[CLOSE_KEY] - begins).seconds))
+
+        if stream[SCHEDULE_KEY] is not None:
+            for segment in stream[SCHEDULE_KEY]:
+                offsets.add(start + segment[0])
+
+    schedule = []
+
+    for offset in sorted(offsets):
+        if offset >= end:
+            continue
+
+        rate = 0
+        accrued = 0
+        for stream in merged:
+            rate += calc_rate_at(stream, begins, offset)
+            accrued += calc_accrued_at(stream, begins, offset)
+
+        schedule.append([offset, rate, accrued])
+
+    return schedule
+
+
+# Rate a stream pays `elapsed` seconds after `begins`
+def calc_rate_at(stream: dict, begins: datetime.datetime, elapsed: int) -> float:
+    local = elapsed - int((stream[BEGIN_KEY] - begins).seconds)
+
+    if local < 0 or local >= int((stream[CLOSE_KEY] - stream[BEGIN_KEY]).seconds):
+        return 0
+
+    if stream[SCHEDULE_KEY] is None:
+        return stream[RATE_KEY]
+
+    rate = 0
+    for segment in stream[SCHEDULE_KEY]:
+        if segment[0] <= local:
+            rate = segment[1]
+    return rate
+
+
+# Amount a stream has accrued `elapsed` seconds after `begins`
+def calc_accrued_at(stream: dict, begins: datetime.datetime, elapsed: int) -> float:
+    local = elapsed - int((stream[BEGIN_KEY] - begins).seconds)
+    duration = int((stream[CLOSE_KEY] - stream[BEGIN_KEY]).seconds)
+
+    if local <= 0:
+        return 0
+    if local > duration:
+        local = duration
+
+    if stream[SCHEDULE_KEY] is None:
+        return stream[RATE_KEY] * local
+
+    return calc_scheduled_accrued(stream[SCHEDULE_KEY], local)
+
+
 def calc_claimable_amount(amount_due: float, sender:str) -> float:
-    return amount_due if amount_due < balances[sender] else balances[sender]
+    balance = balances[sender]
+    return amount_due if amount_due < balance else balance
 
 
 def construct_stream_permit_msg(sender:str, receiver:str, rate:float, begins:str, closes:str, deadline:str) -> str:
@@ -292,3 +1082,13 @@ def construct_stream_permit_msg(sender:str, receiver:str, rate:float, begins:str
 def strptime_ymdhms(date_string: str) -> datetime.datetime:
     return datetime.datetime.strptime(date_string, '%Y-%m-%d %H:%M:%S')
 
+
+# The executor only turns top-level float arguments into decimals; numbers inside
+# list arguments arrive as plain floats and are converted here before any arithmetic
+def to_decimal(value: float):
+    return decimal(str(value))
+
+
+def to_decimals(values: list) -> list:
+    return [to_decimal(value) for value in values]
+